@@ -6,6 +6,8 @@ from sqlalchemy.future import select
 from sqlalchemy.orm import Session
 from sqlalchemy import extract
 from datetime import datetime
+from operator import attrgetter
+from api.schema import Event, EventPyModel
 
 async def process_delete_user(payload: dict):
     async with get_session() as db:
@@ -57,4 +59,12 @@ async def process_edit_event(payload: dict):
                 event.datetime = datetime.fromisoformat(payload['datetime'])
 
             await db.commit()
-    return True
\ No newline at end of file
+    return True
+
+# Event fields read straight from EventTable columns, computed once
+EVENT_COLUMNS = tuple(field for field in EventPyModel.model_fields if field != "tags")
+_get_event_columns = attrgetter(*EVENT_COLUMNS)
+
+def event_to_graphql(event: EventTable) -> Event:
+    """Build the GraphQL Event for an EventTable row without re-validating it."""
+    return Event(**dict(zip(EVENT_COLUMNS, _get_event_columns(event))), tags=event.tags_list)
@@ -9,6 +9,7 @@ from api.schema import Event, EventPyModel, addToCalendarResult, removeFromCalen
 import base64
 from datetime import datetime
 from models import engine
+from api.api_utils import event_to_graphql
 
 
 async def add_to_calendar(self, input: EventInput, info: strawberry.Info) -> addToCalendarResult:
@@ -85,15 +86,8 @@ async def get_calendar(self, input: GetCalendarInput, info: strawberry.Info) ->
         eventList = filtered_events.scalars().all()
         print("add to calendar ", eventList)
 
-        event_dicts = []
-
         for event in eventList:
-            event_dict = {c.key: getattr(event, c.key) for c in inspect(EventTable).mapper.column_attrs}
-            event_dict['tags'] = event.tags_list
-            event_dicts.append(event_dict)
-
-        for event in event_dicts:
-            eventListReturn.append(Event.from_pydantic(EventPyModel.model_validate(event)))
+            eventListReturn.append(event_to_graphql(event))
 
     return GetCalendarResult(calendar=eventListReturn)
 
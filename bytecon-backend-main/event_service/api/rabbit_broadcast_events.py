@@ -0,0 +1,16 @@
+from shared.rabbitmq.rabbit_broadcast import RabbitBroadcast
+from shared.rabbitmq.event_types import EventChanged
+import app
+
+
+class EventChangesBroadcast(RabbitBroadcast):
+    async def process_message(self, payload: dict) -> None:
+        # an event was created, edited or deleted by another replica
+        if payload['message_type'] != 4:
+            return
+        changed = EventChanged.model_validate(payload)
+        if changed.name is None or changed.datetime is None:
+            app.get_search_index().remove(changed.event_id)
+        else:
+            app.get_search_index().update(changed.event_id, changed.name, changed.datetime)
+        app.invalidate_event_queries()
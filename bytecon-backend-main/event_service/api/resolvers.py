@@ -1,14 +1,26 @@
-from sqlalchemy import inspect, select, update
+from sqlalchemy import delete, inspect, select, update
 import json
 import strawberry
-from filter_strategy import NoFilterStrategy, SearchFilterStrategy, RelevanceFilterStrategy, DateFilterStrategy
-from models import get_session
-from models import EventTable
+from filter_strategy import plan_strategy
+from models import get_session, replace_event_tags
+from models import EventTable, EventTagTable
 from api.schema import CreateEventResult, Cursor, DateFilter, EditEvent, EditEventResult, ErrorType, Event, EventConnection, DeleteEventResult, EventEdge, EventInput, EventPyModel, FilterType, GetEventInput, GetEventsResult, GetSingleEventResult, IsAuthenticated, PageInfo, Error, RelevanceFilter, SearchFilter, Success
-import base64
 import app
 import utils 
-import asyncio
+from datetime import datetime
+
+async def broadcast_event_changed(event_id: int, name: str | None, event_datetime: datetime | None) -> None:
+    event_changed_msg = {
+        "message_type": 4,
+        "event_id": event_id,
+        "name": name,
+        "datetime": event_datetime.isoformat() if event_datetime else None
+    }
+    # the change is committed, so a broker outage only leaves the other replicas stale
+    try:
+        await app.get_event_broadcast().publish(json.dumps(event_changed_msg))
+    except Exception as e:
+        print(f"Error broadcasting event change: {e}")
 
 async def create_event(self, input: EventInput, info: strawberry.Info) -> CreateEventResult:
     tags =  [ tag.value for tag in input.tags ]
@@ -28,19 +40,27 @@ async def create_event(self, input: EventInput, info: strawberry.Info) -> Create
             image=image_hash
         )
         db.add(event)
+        await db.flush()
+        await replace_event_tags(db, getattr(event, "id"), tags)
         await db.commit()
-        event_dict = {c.key: getattr(event, c.key) for c in inspect(EventTable).mapper.column_attrs}
-        event_dict['tags'], event_dict['image']  = event.tags_list, input.image
-        return Event.from_pydantic(EventPyModel.model_validate(event_dict))
+        # after the commit, the write lock is not held across storage calls,
+        # and the sweeper restores a lost marker from the events table
+        try:
+            await app.get_azure_blob_handler().add_reference(image_hash, f"event-{getattr(event, 'id')}")
+        except Exception as e:
+            print(f"Error adding image reference: {e}")
+        app.get_search_index().add(getattr(event, "id"), getattr(event, "name"), getattr(event, "datetime"))
+        app.invalidate_event_queries()
+        await broadcast_event_changed(getattr(event, "id"), getattr(event, "name"), getattr(event, "datetime"))
+        return utils.event_to_graphql(event, image=input.image)
 
 async def my_events(first: int | None, after: str | None, info: strawberry.Info) -> GetEventsResult:
     user_id = info.context.user.id
     async with get_session() as db:
         after_id = 0
         if after:
-            cursor_dict = json.loads(base64.b64decode(after))
             try:
-                cursor_type = Cursor(**cursor_dict)
+                cursor_type = utils.decode_cursor(after, Cursor)
                 after_id = cursor_type.id
             except Exception as _:
                 return Error(msg="Invalid request input provided", code=ErrorType.BAD_REQUEST)
@@ -61,7 +81,7 @@ async def my_events(first: int | None, after: str | None, info: strawberry.Info)
         if has_next_page:
             events = events[:-1]
         if events:
-            end_cursor = utils.b64_encode(Cursor(id=getattr(events[-1], "id")).model_dump_json())
+            end_cursor = utils.encode_id_cursor(getattr(events[-1], "id"))
         else:
             end_cursor = None
         
@@ -69,30 +89,33 @@ async def my_events(first: int | None, after: str | None, info: strawberry.Info)
             end_cursor = end_cursor,
             has_next_page = has_next_page
         )
-        get_image_tasks = [app.get_azure_blob_handler().get_blob(getattr(event, "image")) for event in events]
-        images = await asyncio.gather(*get_image_tasks)
         event_list = []
-        for index, event in enumerate(events):
-            event_dict = {c.key: getattr(event, c.key) for c in inspect(EventTable).mapper.column_attrs}
-            event_dict['tags'], event_dict['image'] = event.tags_list, images[index]
-            cursor = utils.b64_encode(Cursor(id=getattr(event, "id")).model_dump_json())
-            event_list.append(EventEdge(cursor=cursor, edge=Event.from_pydantic(EventPyModel.model_validate(event_dict))))
+        for event in events:
+            cursor = utils.encode_id_cursor(getattr(event, "id"))
+            event_list.append(EventEdge(cursor=cursor, edge=utils.event_to_graphql(event, thumbnail=True)))
         return EventConnection(page_info=page_info, edges=event_list)
 
 async def get_events(input: GetEventInput) -> GetEventsResult:
     filter = input.filter
-    if filter:
-        if filter.search_filter:
-            strategy = SearchFilterStrategy()
-        elif filter.relevance_filter:
-            strategy = RelevanceFilterStrategy()
-        elif filter.date_filter:
-            strategy = DateFilterStrategy()
-    else:
-        strategy = NoFilterStrategy()
+    strategy = plan_strategy(filter)
     if input.first is not None and input.first == 0:
         return Error(msg="Invalid query parameter for first provided", code=ErrorType.BAD_REQUEST)
-    return await strategy.execute_query(filter, input.first, input.after) # type: ignore
+
+    query_cache = app.get_query_cache()
+    # filter inputs are unhashable dataclasses, their repr covers every field
+    key = (type(strategy).__name__, repr(filter), input.first, input.after)
+    cached = query_cache.get(key)
+    if cached is not None:
+        return cached
+    generation = query_cache.generation
+    # callers arriving after an event change start a new flight
+    result = await app.get_query_flights().do(
+        (*key, generation), lambda: strategy.execute_query(filter, input.first, input.after) # type: ignore
+    )
+    # skip results that may predate an event change committed meanwhile
+    if isinstance(result, EventConnection) and query_cache.generation == generation:
+        query_cache.set(key, result)
+    return result
 
 async def delete_event(id: int, info: strawberry.Info) -> DeleteEventResult:
     user = info.context.user
@@ -103,8 +126,14 @@ async def delete_event(id: int, info: strawberry.Info) -> DeleteEventResult:
             return Error(msg="This event does not exist", code=ErrorType.EVENT_NOT_FOUND)
         if getattr(result, "created_by") != user.id:
             return Error(msg="User does not have permission for this action", code=ErrorType.PERMISSION_ERROR)
+        await db.execute(delete(EventTagTable).where(EventTagTable.event_id == id))
+        image_hash = getattr(result, "image")
         await db.delete(result)
         await db.commit()
+    await app.get_azure_blob_handler().remove_reference(image_hash, f"event-{id}")
+    app.get_search_index().remove(id)
+    app.invalidate_event_queries()
+    await broadcast_event_changed(id, None, None)
     deletion_event = {
         "message_type": 3,
         "event_id": id
@@ -124,17 +153,29 @@ async def edit_event(input: EditEvent, info: strawberry.Info) -> EditEventResult
         if getattr(result, "created_by") != user.id:
             return Error(msg="User does not have permission for this action", code=ErrorType.PERMISSION_ERROR)            
         update_data = edit_model.model_dump(exclude_none=True, exclude={"id", "tags"})
+        # blob work first, the writes below hold the database write lock until the commit
+        previous_image = getattr(result, "image")
+        image_changed = False
+        if edit_model.image:
+            update_data['image'] = await app.get_azure_blob_handler().upload_blob(edit_model.image)
+            image_changed = update_data['image'] != previous_image
+            if image_changed:
+                await app.get_azure_blob_handler().add_reference(update_data['image'], f"event-{edit_model.id}")
         if edit_model.tags:
             tags = [ tag.value for tag in edit_model.tags ]
             update_data['tags'] = json.dumps(tags)
-        if edit_model.image:
-            update_data['image'] = await app.get_azure_blob_handler().upload_blob(edit_model.image)
+            await replace_event_tags(db, edit_model.id, tags)
         if update_data:
             stmt = update(EventTable).where(EventTable.id == edit_model.id).values(**update_data).execution_options(synchronize_session="fetch")
             await db.execute(stmt)
             await db.commit()
+        if image_changed:
+            await app.get_azure_blob_handler().remove_reference(previous_image, f"event-{edit_model.id}")
         updated_event = await db.execute(select(EventTable).where(EventTable.id == edit_model.id))
         updated_event = updated_event.scalars().one()
+        app.get_search_index().update(getattr(updated_event, "id"), getattr(updated_event, "name"), getattr(updated_event, "datetime"))
+        app.invalidate_event_queries()
+        await broadcast_event_changed(getattr(updated_event, "id"), getattr(updated_event, "name"), getattr(updated_event, "datetime"))
         event_dict = {c.key: getattr(updated_event, c.key) for c in inspect(EventTable).mapper.column_attrs}
         event_dict['tags'] = updated_event.tags_list
         event_model = EventPyModel.model_validate(event_dict)
@@ -150,18 +191,19 @@ async def edit_event(input: EditEvent, info: strawberry.Info) -> EditEventResult
     }
     rabbit = app.get_rabbit_producer()
     await rabbit.send_message(json.dumps(edit_event_msg))
-    return Event.from_pydantic(event_model)
+    return utils.event_to_graphql(updated_event)
 
 async def get_event_by_id(id: int) -> GetSingleEventResult:
+    key = ("get_event_by_id", id, app.get_query_cache().generation)
+    return await app.get_query_flights().do(key, lambda: load_event_by_id(id))
+
+async def load_event_by_id(id: int) -> GetSingleEventResult:
     async with get_session() as db:
         event = await db.execute(select(EventTable).where(EventTable.id == id))
         event = event.scalars().first()
         if event is None:
             return Error(msg="Event not found", code=ErrorType.EVENT_NOT_FOUND)
-        event_dict = {c.key: getattr(event, c.key) for c in inspect(EventTable).mapper.column_attrs}
-        event_dict['tags'] = event.tags_list
-        event_dict['image'] = await app.get_azure_blob_handler().get_blob(event_dict['image'])
-        return Event.from_pydantic(EventPyModel.model_validate(event_dict))
+        return utils.event_to_graphql(event)
 
 @strawberry.type
 class Mutation:
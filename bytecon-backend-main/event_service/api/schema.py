@@ -12,6 +12,8 @@ class TokenData(BaseModel):
 class SearchCursor(BaseModel):
     id: int
     relevance: int
+    snapshot: int | None = None
+    offset: int | None = None
 
 class TagsCursor(BaseModel):
     id: int
@@ -68,7 +70,18 @@ class Event:
     description: strawberry.auto
     created_by: strawberry.auto
     datetime: strawberry.auto
-    image: strawberry.auto
+    # image is resolved only when selected, from the hash of the stored image
+    image_hash: strawberry.Private[str | None] = None
+    image_data: strawberry.Private[str | None] = None
+    thumbnail: strawberry.Private[bool] = False
+
+    @strawberry.field
+    async def image(self, info: strawberry.Info) -> str:
+        if self.image_data is not None:
+            return self.image_data
+        # the request's loaders batch the images of the whole response
+        loader = info.context.thumbnail_loader if self.thumbnail else info.context.image_loader
+        return await loader.load(self.image_hash)
 
 @strawberry.type
 class PageInfo:
@@ -99,11 +112,19 @@ class DateFilter:
     from_: dt | None = None
     to: dt | None = None
 
+@strawberry.input
+class CombinedFilter:
+    search: str | None = None
+    tags: list[Tags] | None = None
+    from_: dt | None = None
+    to: dt | None = None
+
 @strawberry.input(one_of=True)
 class FilterType:
     search_filter: SearchFilter | None = strawberry.UNSET
     relevance_filter: RelevanceFilter | None = strawberry.UNSET
     date_filter: DateFilter | None = strawberry.UNSET
+    combined_filter: CombinedFilter | None = strawberry.UNSET
 
 @strawberry.input
 class GetEventInput:
@@ -1,14 +1,24 @@
 from contextlib import asynccontextmanager
 from functools import cached_property
+import os
 
 from fastapi import FastAPI
 from strawberry.fastapi import GraphQLRouter, BaseContext
 from api.schema import TokenData
 from oauth2 import verify_access_token
 from api.resolvers import schema
+from shared.azure import blob_references
 from shared.azure.access_azure_storage import AzureBlobHandler
+from shared.azure.blob_loader import BlobLoader
+from shared.azure.image_routes import create_image_router
 from shared.rabbitmq import rabbit_provider
+from api.rabbit_broadcast_events import EventChangesBroadcast
+from search_index import CONDITION_CHUNK_SIZE, SearchIndex, create_search_index
+from cache import LRUCache, SingleFlight
 from fastapi.middleware.cors import CORSMiddleware
+from sqlalchemy import select
+from models import EventTable, get_session
+import asyncio
 
 class Context(BaseContext):
     @cached_property 
@@ -21,6 +31,14 @@ class Context(BaseContext):
             return None
         return verify_access_token(authorization)
 
+    @cached_property
+    def image_loader(self) -> BlobLoader:
+        return BlobLoader(azure_blob_handler.get_image)
+
+    @cached_property
+    def thumbnail_loader(self) -> BlobLoader:
+        return BlobLoader(azure_blob_handler.get_thumbnail)
+
 
 def get_context() -> Context:
     return Context()
@@ -31,6 +49,35 @@ def get_azure_blob_handler():
     return azure_blob_handler
 
 
+# "trigram" keeps an in-process index, "fts5" keeps an SQLite FTS5 table in sync
+search_index = create_search_index(os.getenv("SEARCH_BACKEND", "trigram"))
+
+def get_search_index() -> SearchIndex:
+    return search_index
+
+# Ranked results of search queries, referenced from their cursors
+ranking_snapshots = LRUCache(max_size=256, ttl=60)
+
+def get_ranking_snapshots() -> LRUCache:
+    return ranking_snapshots
+
+# getEvents results keyed by (strategy, filter, first, after). The ttl only
+# bounds how long events that have since started stay listed.
+query_cache = LRUCache(max_size=int(os.getenv("QUERY_CACHE_SIZE", "1024")), ttl=60)
+
+def get_query_cache() -> LRUCache:
+    return query_cache
+
+# identical concurrent event queries share one execution
+query_flights = SingleFlight()
+
+def get_query_flights() -> SingleFlight:
+    return query_flights
+
+def invalidate_event_queries() -> None:
+    ranking_snapshots.clear()
+    query_cache.clear()
+
 graphql_app = GraphQLRouter(schema, context_getter=get_context)
 
 rabbit_producer = rabbit_provider.RabbitProducer()
@@ -38,13 +85,56 @@ rabbit_producer = rabbit_provider.RabbitProducer()
 def get_rabbit_producer() -> rabbit_provider.RabbitProducer:
     return rabbit_producer
 
+# event changes from the other event service replicas
+event_broadcast = EventChangesBroadcast("event-changes")
+
+def get_event_broadcast() -> EventChangesBroadcast:
+    return event_broadcast
+
+async def backfill_image_references() -> None:
+    async with get_session() as db:
+        rows = (await db.execute(select(EventTable.id, EventTable.image))).all()
+    await azure_blob_handler.backfill_references((image, f"event-{id}") for id, image in rows)
+
+async def images_in_use(image_hashes: list[str]) -> list[tuple[str, str]]:
+    """(hash, owner) references of the events using any of the images, for the sweeper."""
+    references = []
+    async with get_session() as db:
+        for start in range(0, len(image_hashes), CONDITION_CHUNK_SIZE):
+            chunk = image_hashes[start:start + CONDITION_CHUNK_SIZE]
+            rows = await db.execute(select(EventTable.image, EventTable.id).where(EventTable.image.in_(chunk)))
+            references.extend((image, f"event-{id}") for image, id in rows)
+    return references
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Connect to RabbitMQ when application starts
     await rabbit_producer.connect()
+    await event_broadcast.connect()
+    broadcast_task = asyncio.create_task(event_broadcast.consume_message())
+    # Build the event name search index before serving requests
+    await search_index.build()
+    # opt in, after every service ran once with BLOB_REFERENCE_BACKFILL to record the references made before the index
+    background_tasks = []
+    if os.getenv("BLOB_REFERENCE_BACKFILL", "false").lower() in ("1", "true"):
+        background_tasks.append(asyncio.create_task(backfill_image_references()))
+    if os.getenv("BLOB_GC_INTERVAL_SECONDS"):
+        # profile pictures are only known to the user service database
+        if os.getenv("USERS_DATABASE_URL"):
+            in_use = blob_references.combined_in_use(
+                images_in_use,
+                blob_references.database_in_use(os.environ["USERS_DATABASE_URL"], "user_profiles", "user"),
+            )
+            background_tasks.append(asyncio.create_task(azure_blob_handler.run_sweeper(float(os.environ["BLOB_GC_INTERVAL_SECONDS"]), in_use)))
+        else:
+            print("Not sweeping images: BLOB_GC_INTERVAL_SECONDS needs USERS_DATABASE_URL to check profile pictures")
     yield
     # Close the RabbitMQ connection when application shuts down
     await rabbit_producer.close()
+    await event_broadcast.close()
+    broadcast_task.cancel()
+    for task in background_tasks:
+        task.cancel()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -63,4 +153,17 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-app.include_router(graphql_app, prefix="/graphql")
\ No newline at end of file
+app.include_router(graphql_app, prefix="/graphql")
+app.include_router(create_image_router(get_azure_blob_handler))
+
+@app.get("/stats/cache")
+def cache_stats() -> dict[str, dict[str, int | str]]:
+    return {
+        "queries": query_cache.stats(),
+        "ranking_snapshots": ranking_snapshots.stats(),
+        "query_flights": query_flights.stats(),
+        "blobs": azure_blob_handler.cache.stats(),
+        "blob_fetches": azure_blob_handler.stats(),
+        "sync_messages": rabbit_producer.stats(),
+        "blob_sweep": azure_blob_handler.last_sweep,
+    }
\ No newline at end of file
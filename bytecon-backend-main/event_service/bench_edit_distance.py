@@ -0,0 +1,70 @@
+"""Micro-benchmark for the search ranking edit distance.
+
+Compares the reference DP edit_distance with the bit-parallel
+bounded_edit_distance, with and without a top-k cutoff, over event
+names of realistic length.
+
+    python bench_edit_distance.py [num_events] [search]
+"""
+import heapq
+import random
+import sys
+import timeit
+
+import utils
+
+WORDS = [
+    "Sydney", "Robotics", "Hackathon", "AI", "Meetup", "Web", "Apps", "Workshop",
+    "Cryptography", "Night", "Competitive", "Programming", "Contest", "Embedded",
+    "Systems", "UX", "Design", "Sprint", "Networks", "Databases", "Summit", "2024",
+    "Intro", "to", "Advanced", "Rust", "Python", "Career", "Fair", "Startup", "Pitch",
+]
+
+
+def event_names(count: int, seed: int = 0) -> list[str]:
+    rng = random.Random(seed)
+    return [" ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 5))) for _ in range(count)]
+
+
+def reference(names: list[str], search: str) -> list[int]:
+    return [utils.edit_distance(name, search) for name in names]
+
+
+def bit_parallel(names: list[str], search: str) -> list[int | None]:
+    return [utils.bounded_edit_distance(name, search) for name in names]
+
+
+def bit_parallel_top_k(names: list[str], search: str, k: int = 11) -> list[int]:
+    best: list[int] = []
+    for name in names:
+        max_distance = -best[0] if len(best) == k else None
+        distance = utils.bounded_edit_distance(name, search, max_distance)
+        if distance is None:
+            continue
+        heapq.heappush(best, -distance)
+        if len(best) > k:
+            heapq.heappop(best)
+    return sorted(-distance for distance in best)
+
+
+def main() -> None:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    search = sys.argv[2] if len(sys.argv) > 2 else "robotics hackathon"
+    names = event_names(count)
+
+    expected = reference(names, search)
+    assert bit_parallel(names, search) == expected
+    assert bit_parallel_top_k(names, search) == sorted(expected)[:11]
+
+    print(f"{count} event names, mean length {sum(map(len, names)) / count:.1f}, search {search!r}")
+    for label, func in [
+        ("edit_distance (reference)", reference),
+        ("bounded_edit_distance", bit_parallel),
+        ("bounded_edit_distance, top 10 cutoff", bit_parallel_top_k),
+    ]:
+        seconds = min(timeit.repeat(lambda: func(names, search), number=1, repeat=5))
+        print(f"{label:40} {seconds * 1000:9.2f} ms  {seconds / count * 1e6:7.2f} us/name")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Micro-benchmark for converting EventTable rows to GraphQL Events.
+
+Compares the inspector + EventPyModel + Event.from_pydantic path the
+resolvers used to take with utils.event_to_graphql.
+
+    python bench_event_serialization.py [num_rows]
+"""
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+from sqlalchemy import inspect
+
+import utils
+from api.schema import Event, EventPyModel, Tags
+from models import EventTable
+
+
+def event_rows(count: int) -> list[EventTable]:
+    tags = [tag.value for tag in Tags]
+    rows = []
+    for i in range(count):
+        event = EventTable(
+            id=i,
+            name=f"Event {i}",
+            description="A fairly long description of the event " * 10,
+            location="Sydney",
+            tags_list=tags[i % len(tags):i % len(tags) + 3],
+            created_by=1,
+            datetime=datetime(2030, 1, 1) + timedelta(hours=i),
+            image="0" * 64,
+        )
+        rows.append(event)
+    return rows
+
+
+def before(rows: list[EventTable]) -> list[Event]:
+    events = []
+    for event in rows:
+        event_dict = {c.key: getattr(event, c.key) for c in inspect(EventTable).mapper.column_attrs}
+        event_dict['tags'], event_dict['image'] = event.tags_list, "data:image/jpeg;base64,"
+        events.append(Event.from_pydantic(EventPyModel.model_validate(event_dict)))
+    return events
+
+
+def after(rows: list[EventTable]) -> list[Event]:
+    return [utils.event_to_graphql(event, image="data:image/jpeg;base64,") for event in rows]
+
+
+def fields(events: list[Event]) -> list[tuple]:
+    # the image is a resolver on Event, compare the row fields
+    return [tuple(getattr(event, field) for field in (*utils.EVENT_COLUMNS, "tags")) for event in events]
+
+
+def main() -> None:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000
+    rows = event_rows(count)
+    assert fields(before(rows)) == fields(after(rows))
+
+    print(f"{count} rows")
+    for label, func in [("inspect + model_validate + from_pydantic", before), ("event_to_graphql", after)]:
+        seconds = min(timeit.repeat(lambda: func(rows), number=1, repeat=5))
+        print(f"{label:42} {seconds * 1000:8.2f} ms  {seconds / count * 1e6:7.2f} us/row")
+
+
+if __name__ == "__main__":
+    main()
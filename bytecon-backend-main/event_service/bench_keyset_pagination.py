@@ -0,0 +1,97 @@
+"""Benchmark for paging the unfiltered event listing.
+
+Fills a scratch SQLite database with events whose ids do not follow
+datetime order, then times pages at increasing depth with the separate
+`id > x AND datetime >= y` predicates the strategies used to page with
+and with the `(datetime, id) > (y, x)` row value keyset on
+ix_events_datetime_id. Also reports how many events the separate
+predicates skip over the walk.
+
+    python bench_keyset_pagination.py [num_events] [page_size]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, select, tuple_
+
+from models import Base, EventTable
+
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+
+def fill(engine, count: int, seed: int = 0) -> None:
+    rng = random.Random(seed)
+    start = datetime(2030, 1, 1)
+    # several events share each minute, and ids are in insertion order
+    rows = (
+        (f"Event {i}", "Description", "Sydney", "[]", 1, (start + timedelta(minutes=rng.randrange(count // 4))).strftime(DATETIME_FORMAT), None)
+        for i in range(count)
+    )
+    raw = engine.raw_connection()
+    try:
+        raw.executemany(
+            "INSERT INTO events (name, description, location, tags, created_by, datetime, image) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+        raw.commit()
+    finally:
+        raw.close()
+
+
+def separate_predicates(cursor: tuple[datetime, int]):
+    return select(EventTable).where(EventTable.id > cursor[1]).where(EventTable.datetime >= cursor[0])
+
+
+def row_value(cursor: tuple[datetime, int]):
+    return select(EventTable).where(tuple_(EventTable.datetime, EventTable.id) > cursor)
+
+
+def fetch_page(conn, where, cursor: tuple[datetime, int], page_size: int) -> list[tuple[datetime, int]]:
+    query = where(cursor).order_by(EventTable.datetime, EventTable.id).limit(page_size)
+    return [(row.datetime, row.id) for row in conn.execute(query)]
+
+
+def main() -> None:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    page_size = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(f"sqlite:///{os.path.join(directory, 'bench.db')}")
+        Base.metadata.create_all(engine)
+        started = time.perf_counter()
+        fill(engine, count)
+        print(f"{count} events inserted in {time.perf_counter() - started:.1f} s, page size {page_size}")
+
+        with engine.connect() as conn:
+            ordered = conn.execute(select(EventTable.datetime, EventTable.id).order_by(EventTable.datetime, EventTable.id)).all()
+            print(f"{'depth':>9} {'separate predicates':>22} {'row value keyset':>18} {'skipped':>8}")
+            for depth in [0, 1_000, 10_000, 100_000, count // 2, count - page_size - 1]:
+                if depth >= len(ordered):
+                    continue
+                cursor = tuple(ordered[depth])
+                expected = [tuple(row) for row in ordered[depth + 1:depth + 1 + page_size]]
+                timings = {}
+                for label, where in [("separate", separate_predicates), ("row value", row_value)]:
+                    seconds = min(
+                        timed(lambda: fetch_page(conn, where, cursor, page_size)) for _ in range(5)
+                    )
+                    timings[label] = seconds
+                assert fetch_page(conn, row_value, cursor, page_size) == expected
+                page = fetch_page(conn, separate_predicates, cursor, page_size)
+                skipped = len(set(expected) - set(page))
+                print(f"{depth:>9} {timings['separate'] * 1000:19.2f} ms {timings['row value'] * 1000:15.2f} ms {skipped:>8}")
+        engine.dispose()
+
+
+def timed(func) -> float:
+    started = time.perf_counter()
+    func()
+    return time.perf_counter() - started
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import asyncio
+from collections import OrderedDict
+import time
+from typing import Any, Awaitable, Callable, Hashable, TypeVar
+
+T = TypeVar("T")
+
+
+class LRUCache:
+    """Size bounded LRU cache with an optional time to live per entry.
+
+    generation changes on every clear, so a value computed while the
+    cache was being cleared can be detected and not stored.
+    """
+
+    def __init__(self, max_size: int, ttl: float | None = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.generation = 0
+
+    def get(self, key: Hashable) -> Any | None:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        stored_at, value = entry
+        if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+            del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self.entries[key] = (time.monotonic(), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.generation += 1
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class RankedSnapshot:
+    """Ranked (event id, score) list of a search or relevance query.
+
+    Only the first SNAPSHOT_DEPTH entries are kept, complete records whether
+    that is the whole ranking.
+    """
+
+    def __init__(self, entries: list[tuple[int, int]], complete: bool):
+        self.entries = entries
+        self.complete = complete
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one call.
+
+    Callers arriving while a call for their key is running await its
+    result instead of starting their own. The call runs in its own task
+    and is shielded, so one caller being cancelled does not cancel it for
+    the others.
+    """
+
+    def __init__(self):
+        self.calls: dict[Hashable, asyncio.Task] = {}
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[T]]) -> T:
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self.calls[key] = task
+            task.add_done_callback(lambda _: self.calls.pop(key, None))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "in_flight": len(self.calls),
+            "coalesced": self.coalesced,
+        }
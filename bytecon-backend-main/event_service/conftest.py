@@ -9,7 +9,8 @@ from fastapi import FastAPI, Depends
 import pytest
 import pytest_asyncio
 from typing import AsyncGenerator
-from app import app
+from app import app, get_search_index, invalidate_event_queries
+from search_index import create_search_index
 from models import get_session, Base, EventTable
 from api.schema import Tags
 from oauth2 import create_access_token
@@ -46,6 +47,15 @@ async def cleanup_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.drop_all)
     await create_tables()
+    # dropping the tables also drops the fts5 triggers, rebuild on next use
+    get_search_index().built = False
+    invalidate_event_queries()
+
+@pytest.fixture(scope="function", params=["trigram", "fts5"])
+def search_backend(request, monkeypatch):
+    """Runs a test against every search index, whatever SEARCH_BACKEND is."""
+    monkeypatch.setattr("app.search_index", create_search_index(request.param))
+    return request.param
 
 @pytest.fixture(scope="function")
 def client():
@@ -59,6 +69,50 @@ def auth_headers():
         return {"Authorization": f"{token}"}
     return _auth_headers
 
+@pytest.fixture(scope="function")
+def make_event_input():
+    def _make_event_input(**fields):
+        return {
+            "name": "Test Event",
+            "tags": "[ROBOTICS]",
+            "location": "Test Location",
+            "description": "Test Description",
+            "datetime": "2099-08-01T12:00:00",
+            "image": "testimage.jpg",
+            **fields,
+        }
+    return _make_event_input
+
+@pytest.fixture(scope="function")
+def get_events_page(client):
+    def _get_events_page(headers, first, after=None, filter=None, fields="name"):
+        after_arg = f', after: "{after}"' if after else ""
+        filter_arg = f", filter: {filter}" if filter else ""
+        query = f'''
+            query {{
+                getEvents(input: {{first: {first}{after_arg}{filter_arg}}}) {{
+                    ... on EventConnection {{
+                        edges {{
+                            cursor
+                            edge {{
+                                {fields}
+                            }}
+                        }}
+                        pageInfo {{
+                            endCursor
+                            hasNextPage
+                        }}
+                    }}
+                    ... on Error {{
+                        msg
+                        code
+                    }}
+                }}
+            }}
+        '''
+        return client.post("/graphql", json={"query": query}, headers=headers).json()["data"]["getEvents"]
+    return _get_events_page
+
 @pytest.fixture(scope="function")
 def create_event(client, auth_headers):
     def _create_event(email, event_input):
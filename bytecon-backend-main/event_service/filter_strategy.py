@@ -1,121 +1,198 @@
 from abc import ABC, abstractmethod
-import asyncio
-import base64
 from datetime import datetime
-import json
+import time
 
 from pydantic import BaseModel
-from sqlalchemy import inspect, select
-from typing import Sequence
-from api.schema import DateFilter, DatetimeCursor, Error, ErrorType, Event, EventConnection, EventEdge, EventPyModel, FilterType, GetEventsResult, PageInfo, RelevanceFilter, SearchCursor, SearchFilter, TagsCursor
+from sqlalchemy import and_, func, or_, select, tuple_
+from api.schema import DateFilter, DatetimeCursor, Error, ErrorType, EventConnection, EventEdge, FilterType, GetEventsResult, PageInfo, RelevanceFilter, SearchCursor, SearchFilter, Tags, TagsCursor
 import utils
-from models import EventTable, get_session
+from cache import RankedSnapshot
+from search_index import MAX_CANDIDATES
+from models import EventTable, EventTagTable, get_session
 import app
 
+# number of ranked results kept in a snapshot for the following pages
+SNAPSHOT_DEPTH = 1000
+
 class FilterStrategy(ABC):
     @abstractmethod
     async def execute_query(self, filter: FilterType | None, first: int | None, after: str | None) -> GetEventsResult:
         pass
 
-    async def get_images(self, events: Sequence[EventTable]) -> list[str]:
-        get_image_tasks = [app.get_azure_blob_handler().get_blob(getattr(event, "image")) for event in events]
-        return await asyncio.gather(*get_image_tasks)
+    async def hydrate_events(self, event_ids: list[int]) -> dict[int, EventTable]:
+        """Load the full rows of a page of ranked event ids, keyed by id."""
+        if not event_ids:
+            return {}
+        async with get_session() as db:
+            result = await db.execute(select(EventTable).where(EventTable.id.in_(event_ids)))
+            return {getattr(event, "id"): event for event in result.scalars().all()}
+
+    def get_snapshot_page(self, key: tuple, offset: int, first: int | None) -> tuple[list[tuple[int, int, int]], bool] | None:
+        """Slice a ranked snapshot, returning None when the snapshot cannot serve the page.
+
+        Page entries are (event id, score, snapshot offset following the event).
+        """
+        snapshot = app.get_ranking_snapshots().get(key)
+        if snapshot is None:
+            return None
+        if first is None and not snapshot.complete:
+            return None
+        end = len(snapshot.entries) if first is None else offset + first
+        if end > len(snapshot.entries) and not snapshot.complete:
+            return None
+        page = [(event_id, score, offset + index + 1) for index, (event_id, score) in enumerate(snapshot.entries[offset:end])]
+        return page, end < len(snapshot.entries) or not snapshot.complete
+
+    def take_snapshot(self, key: tuple, ranked: list[tuple[int, int]], first: int) -> tuple[list[tuple[int, int, int]], bool]:
+        """Store the ranking of a first page and return that page."""
+        complete = len(ranked) <= SNAPSHOT_DEPTH
+        app.get_ranking_snapshots().set(key, RankedSnapshot(ranked[:SNAPSHOT_DEPTH], complete))
+        page = [(event_id, score, index + 1) for index, (event_id, score) in enumerate(ranked[:first])]
+        return page, len(ranked) > first
 
 class SearchFilterStrategy(FilterStrategy):
 
     async def execute_query(self, filter: FilterType , first: int | None, after: str | None) -> GetEventsResult:
         search_filter = filter.search_filter
+        now = datetime.now()
+        return await self.search_events(search_filter.search, [EventTable.datetime > now], ("search",), first, after, since=now) # type: ignore
+
+    async def search_events(self, search: str, conditions: list, key: tuple, first: int | None, after: str | None,
+                            use_index: bool = True, since: datetime | None = None) -> GetEventsResult:
+        """Page events matching conditions by edit distance to search.
+
+        key identifies the conditions in ranked snapshot keys, use_index
+        narrows the scored events with the search index first, and since
+        is a lower bound of the datetimes the conditions allow.
+        """
         search_cursor = None
         if after is not None:
             try:
-                search_cursor = SearchCursor(**json.loads(base64.b64decode(after)))
+                search_cursor = utils.decode_cursor(after, SearchCursor)
             except Exception:
                 return Error(msg="Invalid cursor provided", code=ErrorType.BAD_REQUEST)
 
-        async with get_session() as db: 
-            stmt = select(EventTable).where(EventTable.datetime > datetime.now()).order_by(EventTable.datetime, EventTable.id)
-            result = await db.execute(stmt)
-            events = result.scalars().all()
+        snapshot, page = None, None
+        if search_cursor is not None and search_cursor.snapshot is not None and search_cursor.offset is not None:
+            snapshot = search_cursor.snapshot
+            page = self.get_snapshot_page((*key, search, snapshot), search_cursor.offset, first)
+        if page is None:
+            snapshot = None
+            ranked = await self.rank_events(search, conditions, search_cursor, first, use_index, since)
+            if search_cursor is None and first is not None:
+                snapshot = time.time_ns()
+                page = self.take_snapshot((*key, search, snapshot), ranked, first)
+            else:
+                has_next_page = len(ranked) > first if first else False
+                ranked = ranked if first is None else ranked[:first]
+                page = [(event_id, distance, index + 1) for index, (event_id, distance) in enumerate(ranked)], has_next_page
+        ranked_page, has_next_page = page
 
-            events_with_distance = []
-            for event in events:
-                distance = utils.edit_distance(str(getattr(event, "name")), search_filter.search) # type: ignore
-                if search_cursor is not None and (distance > search_cursor.relevance or 
-                                      search_cursor.relevance == distance and search_cursor.id < getattr(event, "id")):
-                    events_with_distance.append((event, distance))
-                elif search_cursor is None:
-                    events_with_distance.append((event, distance))
-            
-            events_with_distance.sort(key=lambda x: x[1])
-            has_next_page = len(events_with_distance) > first if first else False
-            events_with_distance = events_with_distance if first is None else events_with_distance[:first]
+        events = await self.hydrate_events([event_id for event_id, _, _ in ranked_page])
+        # events deleted since they were ranked are skipped
+        ranked_page = [entry for entry in ranked_page if entry[0] in events]
 
-            if events_with_distance:
-                end_cursor = utils.b64_encode(SearchCursor(id=getattr(events_with_distance[-1][0], "id"), relevance=events_with_distance[-1][1]).model_dump_json())
-            else:
-                end_cursor = None
+        if ranked_page:
+            event_id, distance, offset = ranked_page[-1]
+            end_cursor = utils.encode_search_cursor(event_id, distance, snapshot, offset)
+        else:
+            end_cursor = None
+
+        page_info = PageInfo(
+            end_cursor = end_cursor,
+            has_next_page = has_next_page
+        )
 
-            page_info = PageInfo(
-                end_cursor = end_cursor,
-                has_next_page = has_next_page
-            )
-            
         event_list = []
-        images = await self.get_images([event for event, _ in events_with_distance])
-        for index, event_with_distance in enumerate(events_with_distance):
-            event, edit_distance = event_with_distance
-            event_dict = {c.key: getattr(event, c.key) for c in inspect(EventTable).mapper.column_attrs}
-            event_dict['tags'], event_dict['image'] = event.tags_list, images[index]
-            cursor = utils.b64_encode(SearchCursor(id=getattr(event, "id"), relevance=edit_distance).model_dump_json())
-            event_list.append(EventEdge(cursor=cursor, edge=Event.from_pydantic(EventPyModel.model_validate(event_dict))))
+        for event_id, edit_distance, offset in ranked_page:
+            event = events[event_id]
+            cursor = utils.encode_search_cursor(event_id, edit_distance, snapshot, offset)
+            event_list.append(EventEdge(cursor=cursor, edge=utils.event_to_graphql(event, thumbnail=True)))
         return EventConnection(page_info=page_info, edges=event_list)
 
+    async def rank_events(self, search: str, conditions: list, search_cursor: SearchCursor | None, first: int | None,
+                          use_index: bool = True, since: datetime | None = None) -> list[tuple[int, int]]:
+        """Rank events matching conditions by edit distance, returning (event id, distance) pairs."""
+        # the first page ranks deep enough to snapshot the following pages
+        keep = None if first is None else first + 1
+        if keep is not None and search_cursor is None:
+            keep = max(keep, SNAPSHOT_DEPTH + 1)
+        top_k = utils.TopK(keep)
+
+        # only the columns needed for scoring, full rows are loaded for the page
+        stmt = select(EventTable.id, EventTable.name).where(*conditions)
+        if use_index:
+            stmt = await app.get_search_index().restrict(stmt, search, conditions, since)
+        async with get_session() as db:
+            result = await db.stream(stmt)
+            async for event_id, name in result:
+                # candidates worse than the current top k are cut off early
+                distance = utils.bounded_edit_distance(name, search, top_k.threshold())
+                if distance is None:
+                    continue
+                if search_cursor is None or (distance > search_cursor.relevance or 
+                                  search_cursor.relevance == distance and search_cursor.id < event_id):
+                    top_k.push(distance, event_id, event_id)
+        return top_k.items()
+
 
 class RelevanceFilterStrategy(FilterStrategy):
 
     async def execute_query(self, filter: FilterType, first: int | None, after: str | None) -> GetEventsResult:
         relevance_filter = filter.relevance_filter
+        return await self.rank_by_tags(relevance_filter.tags, [EventTable.datetime > datetime.now()], first, after) # type: ignore
+
+    async def rank_by_tags(self, tags: list[Tags], conditions: list, first: int | None, after: str | None) -> GetEventsResult:
+        """Page events matching conditions by the number of tags they share with tags."""
         tags_cursor = None
         if after is not None:
             try:
-                tags_cursor = TagsCursor(**json.loads(base64.b64decode(after)))
+                tags_cursor = utils.decode_cursor(after, TagsCursor)
             except Exception:
                 return Error(msg="Invalid cursor provided", code=ErrorType.BAD_REQUEST)
-        async with get_session() as db: 
-            stmt = select(EventTable).where(EventTable.datetime > datetime.now()).order_by(EventTable.datetime, EventTable.id)
-            result = await db.execute(stmt)
-            events = result.scalars().all()
-            
-            events_with_tags = []
-            for event in events:
-                num_tags = utils.tag_relevance(relevance_filter.tags, event.tags_list) # type: ignore
-                if tags_cursor and (tags_cursor.matching_tags > num_tags or 
-                                        tags_cursor.matching_tags == num_tags and tags_cursor.id < getattr(event, "id")):
-                    events_with_tags.append((event, num_tags))
-                elif tags_cursor is None:
-                    events_with_tags.append((event, num_tags))
-            
-            events_with_tags.sort(key=lambda x: x[1], reverse=True)
-            has_next_page = len(events_with_tags) > first if first else False
-            events_with_tags = events_with_tags if first is None else events_with_tags[:first]
 
-            if events_with_tags:
-                end_cursor = utils.b64_encode(TagsCursor(id=getattr(events_with_tags[-1][0], "id"), matching_tags=events_with_tags[-1][1]).model_dump_json())
-            else:
-                end_cursor = None
+        # only events sharing at least one requested tag have event_tags rows to group
+        tag_values = [tag.value for tag in tags]
+        matching_tags = func.count(EventTagTable.tag).label("matching_tags")
 
-            page_info = PageInfo(
+        async with get_session() as db:
+            query = (
+                select(EventTagTable.event_id, matching_tags)
+                .join(EventTable, EventTable.id == EventTagTable.event_id)
+                .where(EventTagTable.tag.in_(tag_values))
+                .where(*conditions)
+                .group_by(EventTagTable.event_id)
+            )
+            if tags_cursor:
+                query = query.having(or_(
+                    matching_tags < tags_cursor.matching_tags,
+                    and_(matching_tags == tags_cursor.matching_tags, EventTagTable.event_id > tags_cursor.id),
+                ))
+            query = query.order_by(matching_tags.desc(), EventTagTable.event_id)
+            if first:
+                query = query.limit(first + 1)
+            result = await db.execute(query)
+            ranked_page = result.tuples().all()
+
+        has_next_page = len(ranked_page) == first + 1 if first else False
+        if has_next_page:
+            ranked_page = ranked_page[:-1]
+        events = await self.hydrate_events([event_id for event_id, _ in ranked_page])
+        ranked_page = [(event_id, num_tags) for event_id, num_tags in ranked_page if event_id in events]
+        if ranked_page:
+            end_cursor = utils.encode_tags_cursor(*ranked_page[-1])
+        else:
+            end_cursor = None
+
+        page_info = PageInfo(
             end_cursor = end_cursor,
             has_next_page = has_next_page
-            )
+        )
         event_list = []
-        images = await self.get_images([event for event, _ in events_with_tags])
-        for index, event_with_tags in enumerate(events_with_tags):
-            event, matching_tags = event_with_tags
-            event_dict = {c.key: getattr(event, c.key) for c in inspect(EventTable).mapper.column_attrs}
-            event_dict['tags'], event_dict['image'] = event.tags_list, images[index]
-            cursor = utils.b64_encode(TagsCursor(id=getattr(event, "id"), matching_tags=matching_tags).model_dump_json())
-            event_list.append(EventEdge(cursor=cursor, edge=Event.from_pydantic(EventPyModel.model_validate(event_dict))))
+        for event_id, matching_tags in ranked_page:
+            event = events[event_id]
+            cursor = utils.encode_tags_cursor(event_id, matching_tags)
+            event_list.append(EventEdge(cursor=cursor, edge=utils.event_to_graphql(event, thumbnail=True)))
         return EventConnection(page_info=page_info, edges=event_list)
 
 class DateFilterStrategy(FilterStrategy):
@@ -125,7 +202,7 @@ class DateFilterStrategy(FilterStrategy):
         datetime_cursor = None
         if after is not None:
             try:
-                datetime_cursor = DatetimeCursor(**json.loads(base64.b64decode(after)))
+                datetime_cursor = utils.decode_cursor(after, DatetimeCursor)
             except Exception:
                 return Error(msg="Invalid cursor provided", code=ErrorType.BAD_REQUEST)
         if date_filter.from_ is None and date_filter.to is None: # type: ignore
@@ -133,18 +210,13 @@ class DateFilterStrategy(FilterStrategy):
         
         async with get_session() as db:
             query = select(EventTable)
-            if datetime_cursor:
-                from_id = datetime_cursor.id
-                from_datetime = datetime_cursor.datetime
-            else:
-                from_id = 0
-                from_datetime = date_filter.from_ # type: ignore
-
-            if from_datetime:
-                query = query.where(EventTable.datetime >= from_datetime) # type: ignore
+            if date_filter.from_: # type: ignore
+                query = query.where(EventTable.datetime >= date_filter.from_) # type: ignore
             if date_filter.to: # type: ignore
                 query = query.where(EventTable.datetime <= date_filter.to) # type: ignore
-            query = query.where(EventTable.id > from_id).order_by(EventTable.datetime, EventTable.id)
+            if datetime_cursor:
+                query = query.where(tuple_(EventTable.datetime, EventTable.id) > (datetime_cursor.datetime, datetime_cursor.id))
+            query = query.order_by(EventTable.datetime, EventTable.id)
             if first:
                 query = query.limit(first + 1)
             result = await db.execute(query)
@@ -153,7 +225,7 @@ class DateFilterStrategy(FilterStrategy):
             if has_next_page:
                 events = events[:-1]
             if events:
-                end_cursor = utils.b64_encode(DatetimeCursor(id=getattr(events[-1], "id"), datetime=getattr(events[-1], "datetime")).model_dump_json())
+                end_cursor = utils.encode_datetime_cursor(getattr(events[-1], "id"), getattr(events[-1], "datetime"))
             else:
                 end_cursor = None
 
@@ -162,12 +234,9 @@ class DateFilterStrategy(FilterStrategy):
                 has_next_page=has_next_page
             )
             event_list = []
-            images = await self.get_images(events)
-            for index, event in enumerate(events):
-                event_dict = {c.key: getattr(event, c.key) for c in inspect(EventTable).mapper.column_attrs}
-                event_dict['tags'], event_dict['image'] = event.tags_list, images[index]
-                cursor = utils.b64_encode(DatetimeCursor(id=getattr(event, "id"), datetime=getattr(event, "datetime")).model_dump_json())
-                event_list.append(EventEdge(cursor=cursor, edge=Event.from_pydantic(EventPyModel.model_validate(event_dict))))
+            for event in events:
+                cursor = utils.encode_datetime_cursor(getattr(event, "id"), getattr(event, "datetime"))
+                event_list.append(EventEdge(cursor=cursor, edge=utils.event_to_graphql(event, thumbnail=True)))
             
             return EventConnection(page_info=page_info, edges=event_list)
         
@@ -177,14 +246,15 @@ class NoFilterStrategy(FilterStrategy):
         datetime_cursor = None
         if after is not None:
             try:
-                datetime_cursor = DatetimeCursor(**json.loads(base64.b64decode(after)))
+                datetime_cursor = utils.decode_cursor(after, DatetimeCursor)
             except Exception:
                 return Error(msg="Invalid cursor provided", code=ErrorType.BAD_REQUEST)
             
         async with get_session() as db:
             query = select(EventTable)
             if datetime_cursor:
-                query = query.where(EventTable.id > datetime_cursor.id).where(EventTable.datetime >= datetime_cursor.datetime)
+                # seeks straight to the cursor on ix_events_datetime_id
+                query = query.where(tuple_(EventTable.datetime, EventTable.id) > (datetime_cursor.datetime, datetime_cursor.id))
             query = query.order_by(EventTable.datetime, EventTable.id)
             if first:
                 query = query.limit(first + 1)
@@ -195,7 +265,7 @@ class NoFilterStrategy(FilterStrategy):
             if has_next_page:
                 events = events[:-1]
             if events:
-                end_cursor = utils.b64_encode(DatetimeCursor(id=getattr(events[-1], "id"), datetime=getattr(events[-1], "datetime")).model_dump_json())
+                end_cursor = utils.encode_datetime_cursor(getattr(events[-1], "id"), getattr(events[-1], "datetime"))
             else:
                 end_cursor = None
 
@@ -203,12 +273,60 @@ class NoFilterStrategy(FilterStrategy):
                 end_cursor=end_cursor,
                 has_next_page=has_next_page
             )
-            images = await self.get_images(events)
             event_list = []
-            for index, event in enumerate(events):
-                event_dict = {c.key: getattr(event, c.key) for c in inspect(EventTable).mapper.column_attrs}
-                event_dict['tags'], event_dict['image'] = event.tags_list, images[index]
-                cursor = utils.b64_encode(DatetimeCursor(id=getattr(event, "id"), datetime=getattr(event, "datetime")).model_dump_json())
-                event_list.append(EventEdge(cursor=cursor, edge=Event.from_pydantic(EventPyModel.model_validate(event_dict))))
+            for event in events:
+                cursor = utils.encode_datetime_cursor(getattr(event, "id"), getattr(event, "datetime"))
+                event_list.append(EventEdge(cursor=cursor, edge=utils.event_to_graphql(event, thumbnail=True)))
             
-            return EventConnection(page_info=page_info, edges=event_list)
\ No newline at end of file
+            return EventConnection(page_info=page_info, edges=event_list)
+
+
+class CombinedFilterStrategy(FilterStrategy):
+    """Plans a combined search, tags and date range filter.
+
+    The date range and tags become SQL predicates. A search then ranks the
+    events matching them by edit distance, otherwise events are ranked by
+    matching tags, or listed by date when only a range is given. Without a
+    lower bound only upcoming events are searched or ranked, like the
+    single filters.
+    """
+
+    async def execute_query(self, filter: FilterType, first: int | None, after: str | None) -> GetEventsResult:
+        combined_filter = filter.combined_filter
+        search, tags = combined_filter.search, combined_filter.tags # type: ignore
+        from_, to = combined_filter.from_, combined_filter.to # type: ignore
+
+        if not search and not tags:
+            if from_ is None and to is None:
+                return Error(msg="Invalid filter provided", code=ErrorType.BAD_REQUEST)
+            return await DateFilterStrategy().execute_query(FilterType(date_filter=DateFilter(from_=from_, to=to)), first, after)
+
+        since = from_ if from_ is not None else datetime.now()
+        conditions = [EventTable.datetime >= from_ if from_ is not None else EventTable.datetime > since]
+        if to is not None:
+            conditions.append(EventTable.datetime <= to)
+        if not search:
+            return await RelevanceFilterStrategy().rank_by_tags(tags, conditions, first, after) # type: ignore
+
+        if tags:
+            # event_tags, like the ranking by tags
+            tagged = select(EventTagTable.event_id).where(EventTagTable.tag.in_([tag.value for tag in tags]))
+            conditions.append(EventTable.id.in_(tagged))
+        # the search index only pays off when the predicates leave many events to score
+        async with get_session() as db:
+            result = await db.execute(select(func.count()).select_from(EventTable).where(*conditions))
+            use_index = result.scalar_one() > MAX_CANDIDATES
+        key = ("combined", tuple(sorted(tag.value for tag in tags or [])), from_, to)
+        return await SearchFilterStrategy().search_events(search, conditions, key, first, after, use_index, since.replace(tzinfo=None))
+
+
+def plan_strategy(filter: FilterType | None) -> FilterStrategy:
+    if filter is None:
+        return NoFilterStrategy()
+    if filter.search_filter:
+        return SearchFilterStrategy()
+    if filter.relevance_filter:
+        return RelevanceFilterStrategy()
+    if filter.date_filter:
+        return DateFilterStrategy()
+    return CombinedFilterStrategy()
@@ -2,7 +2,7 @@ from contextlib import asynccontextmanager
 import json
 from typing import AsyncGenerator
 
-from sqlalchemy import Column, ForeignKey, Integer, String, Text, DateTime
+from sqlalchemy import Column, ForeignKey, Index, Integer, String, Text, DateTime, delete, exists, select
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 import logging
@@ -24,9 +24,12 @@ class EventTable(Base):
     name = Column(String, nullable=False)
     tags = Column(Text, nullable=False)
     created_by = Column(Integer, nullable=True)
-    datetime = Column(DateTime, nullable=False, index=True)
+    datetime = Column(DateTime, nullable=False)
     image = Column(String, nullable=True)
 
+    # keyset pagination orders and seeks by (datetime, id)
+    __table_args__ = (Index("ix_events_datetime_id", "datetime", "id"),)
+
     @property
     def tags_list(self) -> list[Tags]:
         tags_value = self.__dict__.get('tags')
@@ -40,6 +43,21 @@ class EventTable(Base):
         self.tags = json.dumps(value)
 
 
+class EventTagTable(Base):
+    __tablename__ = "event_tags"
+
+    event_id = Column(Integer, ForeignKey('events.id', ondelete='CASCADE'), primary_key=True, nullable=False)
+    tag = Column(String, primary_key=True, nullable=False)
+
+    __table_args__ = (Index("ix_event_tags_tag_event_id", "tag", "event_id"),)
+
+
+async def replace_event_tags(db: AsyncSession, event_id: int, tags: list[str]) -> None:
+    """Rewrite the event_tags rows of an event, inside the caller's transaction."""
+    await db.execute(delete(EventTagTable).where(EventTagTable.event_id == event_id))
+    db.add_all([EventTagTable(event_id=event_id, tag=tag) for tag in set(tags)])
+
+
 engine = create_async_engine(
     DATABASE_URL, connect_args={"check_same_thread": False}
 )
@@ -52,12 +70,31 @@ async_session = async_sessionmaker(
     autoflush=False,
 )
 
+def add_missing_indexes(conn) -> None:
+    # create_all only creates the indexes of tables it creates
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+    # superseded by ix_events_datetime_id, which the planner would otherwise skip
+    conn.exec_driver_sql("DROP INDEX IF EXISTS ix_events_datetime")
+
 async def migrate_tables() -> None:
     logger.info("Starting to migrate")
 
     engine = create_async_engine(DATABASE_URL, echo=True)
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(add_missing_indexes)
+
+        # backfill event_tags for events written before the table existed
+        result = await conn.execute(
+            select(EventTable.id, EventTable.tags)
+            .where(~exists().where(EventTagTable.event_id == EventTable.id))
+        )
+        for event_id, tags in result.all():
+            tag_rows = [{"event_id": event_id, "tag": tag} for tag in set(json.loads(tags))] if tags else []
+            if tag_rows:
+                await conn.execute(EventTagTable.__table__.insert(), tag_rows)
 
     logger.info("Done migrating")
 
@@ -0,0 +1,255 @@
+from abc import ABC, abstractmethod
+import asyncio
+import heapq
+import re
+from collections import Counter, defaultdict
+from datetime import datetime
+
+from sqlalchemy import Integer, Select, column, select, table, text
+
+from models import EventTable, get_session
+
+NGRAM_SIZE = 3
+MAX_CANDIDATES = 500
+# ranked candidate ids checked against the filter conditions per query
+CONDITION_CHUNK_SIZE = 2000
+
+
+def ngrams(text: str) -> set[str]:
+    # pad so that short words and word boundaries still produce trigrams
+    padded = f"  {text.lower()} "
+    return {padded[i:i + NGRAM_SIZE] for i in range(len(padded) - NGRAM_SIZE + 1)}
+
+
+class SearchIndex(ABC):
+    """Narrows the events SearchFilterStrategy has to rank by edit distance."""
+
+    @abstractmethod
+    async def build(self) -> None:
+        pass
+
+    @abstractmethod
+    def add(self, event_id: int, name: str, event_datetime: datetime) -> None:
+        pass
+
+    @abstractmethod
+    def remove(self, event_id: int) -> None:
+        pass
+
+    def update(self, event_id: int, name: str, event_datetime: datetime) -> None:
+        self.add(event_id, name, event_datetime)
+
+    @abstractmethod
+    async def restrict(self, stmt: Select, search: str, conditions: list, since: datetime | None = None) -> Select:
+        """Restrict an EventTable select to the candidate events for search.
+
+        The candidates are the best matches among the events matching
+        conditions. since, when given, is a lower bound of their datetimes
+        the index may use to skip older events early.
+        """
+        pass
+
+
+class TrigramIndex(SearchIndex):
+    """In-process inverted index from event name trigrams to event ids.
+
+    The index is built from the database on first use (or at startup) and
+    kept up to date by the event mutations.
+    """
+
+    def __init__(self, max_candidates: int = MAX_CANDIDATES):
+        self.max_candidates = max_candidates
+        self.postings: dict[str, set[int]] = defaultdict(set)
+        self.names: dict[int, str] = {}
+        self.datetimes: dict[int, datetime] = {}
+        self.built = False
+        self._lock = asyncio.Lock()
+        # adds and removes made while build reads the events, None when not building
+        self._changes: list[tuple[str, tuple]] | None = None
+
+    async def build(self) -> None:
+        async with self._lock:
+            self._changes = []
+            try:
+                async with get_session() as db:
+                    result = await db.execute(select(EventTable.id, EventTable.name, EventTable.datetime))
+                    rows = result.all()
+                rebuilt = TrigramIndex(self.max_candidates)
+                for event_id, name, event_datetime in rows:
+                    rebuilt.add(event_id, name, event_datetime)
+                for change, args in self._changes:
+                    getattr(rebuilt, change)(*args)
+            finally:
+                self._changes = None
+            # queries keep using the old structures until here, and nothing awaits in between
+            self.postings, self.names, self.datetimes = rebuilt.postings, rebuilt.names, rebuilt.datetimes
+            self.built = True
+
+    def add(self, event_id: int, name: str, event_datetime: datetime) -> None:
+        if self._changes is not None:
+            self._changes.append(("add", (event_id, name, event_datetime)))
+        self._discard(event_id)
+        self.names[event_id] = name
+        # stored naive like the column, an offset from the client would make comparisons fail
+        self.datetimes[event_id] = event_datetime.replace(tzinfo=None)
+        for gram in ngrams(name):
+            self.postings[gram].add(event_id)
+
+    def remove(self, event_id: int) -> None:
+        if self._changes is not None:
+            self._changes.append(("remove", (event_id,)))
+        self._discard(event_id)
+
+    def _discard(self, event_id: int) -> None:
+        name = self.names.pop(event_id, None)
+        self.datetimes.pop(event_id, None)
+        if name is None:
+            return
+        for gram in ngrams(name):
+            posting = self.postings.get(gram)
+            if posting is None:
+                continue
+            posting.discard(event_id)
+            if not posting:
+                del self.postings[gram]
+
+    async def candidates(self, search: str, conditions: list, since: datetime | None = None) -> list[int] | None:
+        """Return ids of events matching conditions sharing the most trigrams with search.
+
+        None means the search cannot be narrowed and every event should be scored.
+        """
+        if not search.strip():
+            return None
+        if not self.built:
+            await self.build()
+
+        counts: Counter[int] = Counter()
+        for gram in ngrams(search):
+            counts.update(self.postings.get(gram, ()))
+        ranking = [
+            (-count, event_id) for event_id, count in counts.items()
+            if since is None or self.datetimes[event_id] >= since
+        ]
+        if not conditions:
+            return [event_id for _, event_id in heapq.nsmallest(self.max_candidates, ranking)]
+        # the conditions are checked in the database, a chunk of the ranking at a time,
+        # popped off a heap so only the part of the ranking that is checked gets ordered
+        heapq.heapify(ranking)
+        best: list[int] = []
+        async with get_session() as db:
+            while ranking:
+                chunk = [heapq.heappop(ranking)[1] for _ in range(min(CONDITION_CHUNK_SIZE, len(ranking)))]
+                result = await db.execute(select(EventTable.id).where(EventTable.id.in_(chunk)).where(*conditions))
+                matching = set(result.scalars().all())
+                best.extend(event_id for event_id in chunk if event_id in matching)
+                if len(best) >= self.max_candidates:
+                    break
+        return best[:self.max_candidates]
+
+    async def restrict(self, stmt: Select, search: str, conditions: list, since: datetime | None = None) -> Select:
+        candidate_ids = await self.candidates(search, conditions, since)
+        if candidate_ids is None:
+            return stmt
+        return stmt.where(EventTable.id.in_(candidate_ids))
+
+
+FTS5_SCHEMA = [
+    # the word tokenized table of earlier versions, replaced by events_trigrams
+    "DROP TRIGGER IF EXISTS events_fts_insert",
+    "DROP TRIGGER IF EXISTS events_fts_delete",
+    "DROP TRIGGER IF EXISTS events_fts_update",
+    "DROP TABLE IF EXISTS events_fts",
+    """CREATE VIRTUAL TABLE IF NOT EXISTS events_trigrams USING fts5(
+        name, description, location, content='events', content_rowid='id', tokenize='trigram'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS events_trigrams_insert AFTER INSERT ON events BEGIN
+        INSERT INTO events_trigrams(rowid, name, description, location)
+        VALUES (new.id, new.name, new.description, new.location);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS events_trigrams_delete AFTER DELETE ON events BEGIN
+        INSERT INTO events_trigrams(events_trigrams, rowid, name, description, location)
+        VALUES ('delete', old.id, old.name, old.description, old.location);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS events_trigrams_update AFTER UPDATE ON events BEGIN
+        INSERT INTO events_trigrams(events_trigrams, rowid, name, description, location)
+        VALUES ('delete', old.id, old.name, old.description, old.location);
+        INSERT INTO events_trigrams(rowid, name, description, location)
+        VALUES (new.id, new.name, new.description, new.location);
+    END""",
+]
+
+EVENTS_FTS = table("events_trigrams", column("rowid", Integer))
+# name matches count for more than description or location matches
+FTS5_RANK = text("bm25(events_trigrams, 10.0, 1.0, 2.0)")
+
+
+def fts5_query(search: str) -> str | None:
+    """Match any trigram of the search terms, so misspelled words still find events.
+
+    Returns None when no term is long enough to have a trigram.
+    """
+    trigrams = {
+        term[i:i + NGRAM_SIZE]
+        for term in re.findall(r"\w+", search.lower())
+        for i in range(len(term) - NGRAM_SIZE + 1)
+    }
+    if not trigrams:
+        return None
+    return " OR ".join(f'"{trigram}"' for trigram in sorted(trigrams))
+
+
+class Fts5Index(SearchIndex):
+    """SQLite FTS5 trigram table over events.name, description and location.
+
+    The table is an external content table kept in sync by triggers, so the
+    mutations do not have to call add/remove. A search matches any of its
+    trigrams, so misspelled words still find candidates. bm25 picks the
+    candidate window inside SQLite, the candidates are then ranked by edit
+    distance like those of the trigram index, so both page through the
+    same order.
+    """
+
+    def __init__(self, max_candidates: int = MAX_CANDIDATES):
+        self.max_candidates = max_candidates
+        self.built = False
+        self._lock = asyncio.Lock()
+
+    async def build(self) -> None:
+        async with self._lock:
+            async with get_session() as db:
+                for statement in FTS5_SCHEMA:
+                    await db.execute(text(statement))
+                await db.execute(text("INSERT INTO events_trigrams(events_trigrams) VALUES ('rebuild')"))
+                await db.commit()
+            self.built = True
+
+    def add(self, event_id: int, name: str, event_datetime: datetime) -> None:
+        pass
+
+    def remove(self, event_id: int) -> None:
+        pass
+
+    async def restrict(self, stmt: Select, search: str, conditions: list, since: datetime | None = None) -> Select:
+        query = fts5_query(search)
+        if query is None:
+            return stmt
+        if not self.built:
+            await self.build()
+        # the window is taken among the events matching conditions
+        candidates = (
+            select(EVENTS_FTS.c.rowid)
+            .join(EventTable, EventTable.id == EVENTS_FTS.c.rowid)
+            .where(text("events_trigrams MATCH :query").bindparams(query=query))
+            .where(*conditions)
+            .order_by(FTS5_RANK)
+            .limit(self.max_candidates)
+        )
+        return stmt.where(EventTable.id.in_(candidates))
+
+
+def create_search_index(backend: str) -> SearchIndex:
+    if backend == "fts5":
+        return Fts5Index()
+    if backend == "trigram":
+        return TrigramIndex()
+    raise ValueError(f"Unknown search backend {backend}")
@@ -1,4 +1,36 @@
+import asyncio
+import base64
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+import hashlib
+from io import BytesIO
+import os
+import random
+import time
+
+from aio_pika import DeliveryMode
+from PIL import Image
 import pytest
+from sqlalchemy import select, text, update
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from api.rabbit_broadcast_events import EventChangesBroadcast
+from api.schema import Cursor, DatetimeCursor, SearchCursor, Tags, TagsCursor
+import app
+from cache import SingleFlight
+import filter_strategy
+from models import EventTable, get_session
+import search_index
+from shared.azure import blob_cache, blob_references
+from shared.azure.access_azure_storage import AzureBlobHandler
+from shared.azure.blob_cache import BlobCache
+from shared.azure.blob_loader import BlobLoader
+from shared.azure.blob_storage import AzureBlobStorage, BlobNotFound, LocalBlobStorage, MemoryBlobStorage
+from shared.azure.image_format import VERBATIM, decode_data_url, encode_data_url
+from shared.azure.image_routes import image_response
+from shared.azure.thumbnails import THUMBNAIL_SIZE, make_thumbnail
+from shared.rabbitmq.rabbit_provider import RabbitProducer
+import utils
 
 
 @pytest.mark.asyncio
@@ -297,3 +329,739 @@ async def test_delete_event_repeat(client, create_event):
 
     # try get event cursor for after
 
+
+@pytest.mark.asyncio
+async def test_edit_event_writes_after_blob_work(client, create_event, monkeypatch, make_event_input):
+    handler = app.get_azure_blob_handler()
+    monkeypatch.setattr(handler, "storage", MemoryBlobStorage())
+    monkeypatch.setattr(handler, "known_blobs", {})
+    data, headers = create_event("editlock@example.com", make_event_input())
+    event_id = data["data"]["createEvent"]["id"]
+    add_reference = handler.add_reference
+    async def add_reference_with_writer(image_hash, owner):
+        # another writer gets the database while the edit talks to the storage
+        async with get_session() as db:
+            await db.execute(update(EventTable).where(EventTable.id == event_id).values(location="Moved Location"))
+            await db.commit()
+        await add_reference(image_hash, owner)
+    monkeypatch.setattr(handler, "add_reference", add_reference_with_writer)
+    mutation = f'mutation {{ editEvent(input: {{id: {event_id}, tags: [CRYPTOGRAPHY], image: "editedimage.jpg"}}) {{ ... on Event {{ tags location image }} }} }}'
+    data = client.post("/graphql", json={"query": mutation}, headers=headers).json()
+    assert "errors" not in data
+    async with get_session() as db:
+        event = (await db.execute(select(EventTable).where(EventTable.id == event_id))).scalars().one()
+    assert (event.tags_list, event.location, event.image) == ([Tags.CRYPTOGRAPHY], "Moved Location", hashlib.sha256(b"editedimage.jpg").hexdigest())
+
+@pytest.mark.asyncio
+async def test_get_events_search(create_event, get_events_page, search_backend, make_event_input):
+    names = ["Robotics Hackathon", "Robotics Meetup", "Database Night"]
+    headers = None
+    for i, name in enumerate(names):
+        event_input = make_event_input(name=name, datetime=f"2099-08-0{i + 1}T12:00:00")
+        _, headers = create_event("searchevents@example.com", event_input)
+
+    page = get_events_page(headers, 10, filter='{searchFilter: {search: "robotics hackathon"}}', fields="id name")
+    assert [edge["edge"]["name"] for edge in page["edges"]] == ["Robotics Hackathon", "Robotics Meetup"]
+    assert page["pageInfo"]["hasNextPage"] == False
+    # misspelled searches still find the event
+    page = get_events_page(headers, 10, filter='{searchFilter: {search: "robotcs hackaton"}}')
+    assert page["edges"][0]["edge"]["name"] == "Robotics Hackathon"
+
+@pytest.mark.asyncio
+async def test_get_events_search_after_offset_datetime(client, create_event, make_event_input):
+    event_input = make_event_input(name="Robotics Hackathon", datetime="2099-08-02T12:00:00+00:00")
+    query = 'query { getEvents(input: {first: 10, filter: {searchFilter: {search: "robotics hackathon"}}}) { ... on EventConnection { edges { edge { name } } } ... on Error { msg } } }'
+    # the index is built before the event is created, as at startup
+    await app.get_search_index().build()
+    _, headers = create_event("offsetsearch@example.com", event_input)
+    # as from a replica broadcasting an offset datetime
+    app.get_search_index().update(999, "Robotics Meetup", datetime(2099, 8, 3, tzinfo=timezone.utc))
+    data = client.post("/graphql", json={"query": query}, headers=headers).json()
+    assert "errors" not in data
+    assert [edge["edge"]["name"] for edge in data["data"]["getEvents"]["edges"]] == ["Robotics Hackathon"]
+
+@pytest.mark.asyncio
+async def test_trigram_index_keeps_changes_made_while_building(client, create_event, monkeypatch, make_event_input):
+    data, _ = create_event("indexbuild@example.com", make_event_input(name="Robotics Hackathon"))
+    deleted_id = data["data"]["createEvent"]["id"]
+    index = search_index.TrigramIndex()
+    read_session = search_index.get_session
+    @asynccontextmanager
+    async def session_with_mutations():
+        async with read_session() as db:
+            # an event is created and another deleted before the rows are read
+            index.add(999, "Robotics Meetup", datetime(2099, 8, 3))
+            index.remove(deleted_id)
+            yield db
+    monkeypatch.setattr(search_index, "get_session", session_with_mutations)
+    await index.build()
+    assert index.names == {999: "Robotics Meetup"}
+    monkeypatch.setattr(search_index, "get_session", read_session)
+    assert await index.candidates("robotics", []) == [999]
+
+def test_bounded_edit_distance_matches_reference():
+    rng = random.Random(0)
+    alphabet = "abcXYZ "
+    for _ in range(2000):
+        name = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 20)))
+        search = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 20)))
+        expected = utils.edit_distance(name, search)
+        assert utils.bounded_edit_distance(name, search) == expected
+        max_distance = rng.randint(0, 10)
+        assert utils.bounded_edit_distance(name, search, max_distance) == (expected if expected <= max_distance else None)
+
+@pytest.mark.asyncio
+async def test_get_events_relevance_pagination(create_event, get_events_page, make_event_input):
+    tags = ["[ROBOTICS, NETWORKS]", "[ROBOTICS]", "[DATABASES]", "[ROBOTICS, NETWORKS]", "[NETWORKS]"]
+    headers = None
+    for i, event_tags in enumerate(tags):
+        event_input = make_event_input(name=f"Test Event {i}", tags=event_tags, datetime=f"2099-08-0{i + 1}T12:00:00")
+        _, headers = create_event("relevanceevents@example.com", event_input)
+
+    def get_page(after):
+        page = get_events_page(headers, 2, after, filter="{relevanceFilter: {tags: [ROBOTICS, NETWORKS]}}")
+        return [edge["edge"]["name"] for edge in page["edges"]], page["pageInfo"]
+
+    names, page_info = get_page(None)
+    assert names == ["Test Event 0", "Test Event 3"]
+    assert page_info["hasNextPage"] == True
+    # events sharing none of the requested tags are left out
+    names, page_info = get_page(page_info["endCursor"])
+    assert names == ["Test Event 1", "Test Event 4"]
+    assert page_info["hasNextPage"] == False
+
+def test_top_k_matches_full_sort():
+    rng = random.Random(0)
+    rows = [(rng.randint(0, 5), id) for id in rng.sample(range(1000), 200)]
+    for k in [None, 1, 10, 199, 500]:
+        top_k = utils.TopK(k)
+        for score, id in rows:
+            top_k.push(score, id, id)
+        expected = sorted(rows)[:k]
+        assert top_k.items() == [(id, score) for score, id in expected]
+
+@pytest.mark.asyncio
+async def test_get_events_search_pagination(create_event, get_events_page, search_backend, make_event_input):
+    names = ["Robotics Hackathon", "Robotics Hackathons", "Robotics Meetup"]
+    headers = None
+    for i, name in enumerate(names):
+        event_input = make_event_input(name=name, datetime=f"2099-08-0{i + 1}T12:00:00")
+        _, headers = create_event("searchpages@example.com", event_input)
+
+    def get_page(after):
+        page = get_events_page(headers, 1, after, filter='{searchFilter: {search: "robotics hackathon"}}')
+        return [edge["edge"]["name"] for edge in page["edges"]], page["pageInfo"]
+
+    first_names, first_page_info = get_page(None)
+    assert first_names == ["Robotics Hackathon"]
+    assert first_page_info["hasNextPage"] == True
+    names, page_info = get_page(first_page_info["endCursor"])
+    assert names == ["Robotics Hackathons"]
+    assert page_info["hasNextPage"] == True
+
+    # pages keep working once the ranked snapshot is gone
+    app.get_ranking_snapshots().clear()
+    names, fallback_page_info = get_page(first_page_info["endCursor"])
+    assert names == ["Robotics Hackathons"]
+    assert fallback_page_info["hasNextPage"] == True
+    names, page_info = get_page(fallback_page_info["endCursor"])
+    assert names == ["Robotics Meetup"]
+    assert page_info["hasNextPage"] == False
+
+def test_cursor_codec_round_trip_and_legacy():
+    cursors = [
+        (utils.encode_search_cursor(7, 3), SearchCursor(id=7, relevance=3)),
+        (utils.encode_search_cursor(7, 3, 1723456789123456789, 42), SearchCursor(id=7, relevance=3, snapshot=1723456789123456789, offset=42)),
+        (utils.encode_tags_cursor(9, 2), TagsCursor(id=9, matching_tags=2)),
+        (utils.encode_datetime_cursor(5, datetime(2099, 8, 2, 12, 0, 0, 123)), DatetimeCursor(id=5, datetime=datetime(2099, 8, 2, 12, 0, 0, 123))),
+        (utils.encode_id_cursor(11), Cursor(id=11)),
+    ]
+    for encoded, expected in cursors:
+        assert "=" not in encoded
+        assert utils.decode_cursor(encoded, type(expected)) == expected
+        legacy = base64.b64encode(expected.model_dump_json().encode()).decode()
+        assert utils.decode_cursor(legacy, type(expected)) == expected
+    assert len(cursors[1][0]) < len(base64.b64encode(cursors[1][1].model_dump_json().encode()))
+
+    with pytest.raises(ValueError):
+        utils.decode_cursor(utils.encode_id_cursor(11), SearchCursor)
+    with pytest.raises(ValueError):
+        utils.decode_cursor("not a cursor", Cursor)
+
+@pytest.mark.asyncio
+async def test_get_events_keyset_pagination(create_event, get_events_page, make_event_input):
+    # ids do not follow datetime order, and two events share a datetime
+    datetimes = ["2099-08-03T12:00:00", "2099-08-01T12:00:00", "2099-08-02T12:00:00", "2099-08-01T12:00:00"]
+    headers = None
+    for i, event_datetime in enumerate(datetimes):
+        event_input = make_event_input(name=f"Keyset Event {i}", datetime=event_datetime)
+        _, headers = create_event("keysetevents@example.com", event_input)
+
+    def get_all(filter: str | None) -> list[str]:
+        names, after = [], None
+        while True:
+            page = get_events_page(headers, 1, after, filter=filter)
+            names += [edge["edge"]["name"] for edge in page["edges"]]
+            if not page["pageInfo"]["hasNextPage"]:
+                return names
+            after = page["pageInfo"]["endCursor"]
+
+    expected = ["Keyset Event 1", "Keyset Event 3", "Keyset Event 2", "Keyset Event 0"]
+    assert get_all(None) == expected
+    assert get_all('{dateFilter: {from_: "2099-08-01T00:00:00"}}') == expected
+    assert get_all('{dateFilter: {from_: "2099-08-01T00:00:00", to: "2099-08-02T23:00:00"}}') == expected[:3]
+
+@pytest.mark.asyncio
+async def test_get_events_combined_filter(create_event, get_events_page, make_event_input):
+    events = [
+        ("Robotics Hackathon", "[ROBOTICS]", "2099-08-01T12:00:00"),
+        ("Robotics Hackathon", "[WEB_APPS]", "2099-08-02T12:00:00"),
+        ("Robotics Hackathon", "[ROBOTICS]", "2099-10-01T12:00:00"),
+        ("Robotics Hackathons", "[ROBOTICS, NETWORKS]", "2099-08-03T12:00:00"),
+        ("Database Night", "[ROBOTICS, NETWORKS]", "2099-08-04T12:00:00"),
+    ]
+    headers = None
+    for name, tags, event_datetime in events:
+        event_input = make_event_input(name=name, tags=tags, datetime=event_datetime)
+        _, headers = create_event("combinedevents@example.com", event_input)
+
+    def get_events(filter: str) -> list[tuple[str, str]]:
+        page = get_events_page(headers, 10, filter=f"{{combinedFilter: {filter}}}", fields="name datetime")
+        if "code" in page:
+            return page["code"]
+        return [(edge["edge"]["name"], edge["edge"]["datetime"]) for edge in page["edges"]]
+
+    window = 'from_: "2099-08-01T00:00:00", to: "2099-08-31T00:00:00"'
+    assert get_events(f'{{search: "robotics hackathon", tags: [ROBOTICS], {window}}}') == [
+        ("Robotics Hackathon", "2099-08-01T12:00:00"),
+        ("Robotics Hackathons", "2099-08-03T12:00:00"),
+        ("Database Night", "2099-08-04T12:00:00"),
+    ]
+    # without a search, events are ranked by matching tags
+    assert get_events(f'{{tags: [ROBOTICS, NETWORKS], {window}}}') == [
+        ("Robotics Hackathons", "2099-08-03T12:00:00"),
+        ("Database Night", "2099-08-04T12:00:00"),
+        ("Robotics Hackathon", "2099-08-01T12:00:00"),
+    ]
+    assert get_events('{to: "2099-08-02T23:00:00"}') == [
+        ("Robotics Hackathon", "2099-08-01T12:00:00"),
+        ("Robotics Hackathon", "2099-08-02T12:00:00"),
+    ]
+    assert get_events('{}') == "BAD_REQUEST"
+
+@pytest.mark.asyncio
+async def test_get_events_combined_filter_uses_index_window_after_predicates(create_event, get_events_page, search_backend, monkeypatch, make_event_input):
+    # few enough candidates that the index window matters
+    monkeypatch.setattr(filter_strategy, "MAX_CANDIDATES", 2)
+    monkeypatch.setattr(app.get_search_index(), "max_candidates", 2)
+    events = [("Robotics Hackathon", f"2099-09-0{day}T12:00:00") for day in range(1, 4)]
+    events += [("Database Night", f"2099-08-0{day}T12:00:00") for day in range(1, 4)]
+    events += [("Robotics Hackathon", "2099-08-05T12:00:00"), ("Robotics Hackathon", "2020-08-05T12:00:00")]
+    headers = None
+    for name, event_datetime in events:
+        event_input = make_event_input(name=name, datetime=event_datetime)
+        _, headers = create_event("combinedwindow@example.com", event_input)
+
+    def get_events(window: str) -> list[tuple[str, str]]:
+        filter = f'{{combinedFilter: {{search: "robotics hackathon", tags: [ROBOTICS], {window}}}}}'
+        page = get_events_page(headers, 10, filter=filter, fields="name datetime")
+        return [(edge["edge"]["name"], edge["edge"]["datetime"]) for edge in page["edges"]]
+
+    assert get_events('from_: "2099-08-01T00:00:00", to: "2099-08-31T00:00:00"')[0] == ("Robotics Hackathon", "2099-08-05T12:00:00")
+    # past events are searched when the range starts in the past
+    assert get_events('from_: "2020-01-01T00:00:00", to: "2020-12-31T00:00:00"') == [("Robotics Hackathon", "2020-08-05T12:00:00")]
+
+@pytest.mark.asyncio
+async def test_get_events_query_cache(client, create_event, get_events_page, make_event_input):
+    event_input = make_event_input(name="Cached Event")
+    _, headers = create_event("cachedevents@example.com", event_input)
+
+    def get_names() -> list[str]:
+        return [edge["edge"]["name"] for edge in get_events_page(headers, 10)["edges"]]
+
+    stats = client.get("/stats/cache").json()["queries"]
+    assert get_names() == ["Cached Event"]
+    assert get_names() == ["Cached Event"]
+    new_stats = client.get("/stats/cache").json()["queries"]
+    assert new_stats["misses"] == stats["misses"] + 1
+    assert new_stats["hits"] == stats["hits"] + 1
+
+    # committing a new event invalidates the cached page
+    create_event("cachedevents@example.com", {**event_input, "name": "Another Cached Event", "datetime": "2099-08-02T12:00:00"})
+    assert get_names() == ["Cached Event", "Another Cached Event"]
+
+    # so does a change broadcast by another replica
+    assert app.get_query_cache().stats()["size"] == 1
+    await EventChangesBroadcast("event-changes").process_message({"message_type": 4, "event_id": 1, "name": None, "datetime": None})
+    assert app.get_query_cache().stats()["size"] == 0
+
+@pytest.mark.asyncio
+async def test_mutations_survive_broadcast_failures(client, create_event, monkeypatch, make_event_input):
+    async def failing_publish(message):
+        raise ConnectionError("broker unavailable")
+    monkeypatch.setattr(app.get_event_broadcast(), "publish", failing_publish)
+    event_input = make_event_input(name="Broadcast Event")
+    data, headers = create_event("broadcast@example.com", event_input)
+    event_id = data["data"]["createEvent"]["id"]
+    mutation = f'mutation {{ deleteEvent(id: {event_id}) {{ ... on Success {{ success }} }} }}'
+    data = client.post("/graphql", json={"query": mutation}, headers=headers).json()
+    assert data["data"]["deleteEvent"]["success"] is True
+
+@pytest.mark.asyncio
+async def test_single_flight_coalesces_concurrent_calls():
+    flights = SingleFlight()
+    calls = 0
+
+    async def load(value):
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        if value is None:
+            raise ValueError("no value")
+        return value
+
+    results = await asyncio.gather(*(flights.do("key", lambda: load(1)) for _ in range(10)))
+    assert results == [1] * 10
+    assert calls == 1
+    assert flights.stats() == {"in_flight": 0, "coalesced": 9}
+
+    results = await asyncio.gather(*(flights.do("missing", lambda: load(None)) for _ in range(3)), return_exceptions=True)
+    assert all(isinstance(result, ValueError) for result in results)
+    assert calls == 2
+
+    # a finished call is not reused
+    assert await flights.do("key", lambda: load(2)) == 2
+    assert calls == 3
+
+@pytest.mark.asyncio
+async def test_blob_cache_tiers(tmp_path):
+    # each file on disk is a 10 byte content type line and 6 bytes of image
+    cache = BlobCache(str(tmp_path), max_memory_bytes=10, max_disk_bytes=40)
+    await cache.set("a", "image/png", b"aaaaaa")
+    await cache.set("b", "image/png", b"bbbbbb")
+    assert cache.stats()["memory_evictions"] == 1
+    assert await cache.get("b") == ("image/png", b"bbbbbb")
+    # evicted from memory but still on disk
+    assert await cache.get("a") == ("image/png", b"aaaaaa")
+    assert cache.stats()["memory_hits"] == 1
+    assert cache.stats()["disk_hits"] == 1
+
+    await cache.set("c", "image/png", b"cccccc")
+    await cache.set("d", "image/png", b"dddddd")
+    assert cache.stats()["disk_evictions"] > 0
+    assert cache.stats()["disk_bytes"] <= 40
+    assert await BlobCache(str(tmp_path), 10, 40).get("d") == ("image/png", b"dddddd")
+    assert await cache.get("missing") is None
+    assert cache.stats()["misses"] == 1
+
+@pytest.mark.asyncio
+async def test_blob_cache_write_errors(tmp_path, monkeypatch):
+    cache = blob_cache.BlobCache(str(tmp_path), max_memory_bytes=10, max_disk_bytes=40)
+    def full_disk(source, destination):
+        raise OSError(28, "No space left on device")
+    monkeypatch.setattr(blob_cache.os, "replace", full_disk)
+    await cache.set("a", "image/png", b"aaaaaa")
+    assert cache.stats()["disk_errors"] == 1
+    # the temporary file is removed and the memory tier still serves the entry
+    assert os.listdir(cache.directory) == []
+    assert await cache.get("a") == ("image/png", b"aaaaaa")
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("backend", ["local", "memory"])
+async def test_blob_storage_backends(tmp_path, backend):
+    storage = LocalBlobStorage(str(tmp_path)) if backend == "local" else MemoryBlobStorage()
+    await storage.upload("a", b"aaaaaa", "image/png")
+    assert await storage.download("a") == ("image/png", b"aaaaaa")
+    assert await storage.exists("a")
+    assert [blob.name async for blob in storage.list_blobs()] == ["a"]
+    await storage.delete("a")
+    assert not await storage.exists("a")
+    with pytest.raises(BlobNotFound):
+        await storage.download("a")
+
+    handler = AzureBlobHandler("shared/azure/images/default-event.jpg", storage=storage)
+    handler.cache = type(handler.cache)(None, 1024 * 1024, 0)
+    image_hash = await handler.upload_blob("data:image/png;base64,iVBORw0KGgo=")
+    assert image_hash != handler.default_image_hash
+    handler.cache.memory.clear()
+    assert await handler.fetch_blob(image_hash) == "data:image/png;base64,iVBORw0KGgo="
+    # a thumbnail would not be smaller, so the original is served for it
+    assert (await storage.download(f"{image_hash}-thumb320"))[1] == b""
+    handler.cache.memory.clear()
+    assert await handler.fetch_thumbnail(image_hash) == await handler.fetch_image(image_hash)
+
+@pytest.mark.asyncio
+async def test_upload_blob_skips_stored_images():
+    storage = MemoryBlobStorage()
+    uploads = []
+    upload = storage.upload
+    async def counting_upload(name, data, content_type):
+        uploads.append(name)
+        await upload(name, data, content_type)
+    storage.upload = counting_upload
+    image = "data:image/png;base64,iVBORw0KGgo="
+    handler = AzureBlobHandler("shared/azure/images/default-event.jpg", storage=storage)
+    image_hash = await handler.upload_blob(image)
+    assert await handler.upload_blob(image) == image_hash
+    # a replica without the hash in its index finds it in the storage
+    other = AzureBlobHandler("shared/azure/images/default-event.jpg", storage=storage)
+    assert await other.upload_blob(image) == image_hash
+    # only the grace period marker is written again
+    assert uploads == [image_hash, f"{image_hash}-thumb320", f"{image_hash}.released", f"{image_hash}.released"]
+    # and not while the image is referenced
+    await handler.add_reference(image_hash, "event-1")
+    assert await handler.upload_blob(image) == image_hash
+    assert uploads[4:] == [f"{image_hash}.ref.event-1"]
+
+@pytest.mark.asyncio
+async def test_upload_blob_handles_malformed_data_urls(tmp_path):
+    handler = AzureBlobHandler("shared/azure/images/default-event.jpg", storage=LocalBlobStorage(str(tmp_path / "blobs")))
+    handler.cache = BlobCache(str(tmp_path / "cache"), 1024 * 1024, 1024 * 1024)
+    assert await handler.upload_blob("data:image/png;base64,@@notb64") == handler.default_image_hash
+    # content types that would break the line based local formats are stored as opaque bytes
+    for content_type in ["image/pn\ng", "imagé/png"]:
+        image_hash = await handler.upload_blob(f"data:{content_type};base64,iVBORw0KGgo=")
+        assert image_hash != handler.default_image_hash
+        handler.cache.memory.clear()
+        assert await handler.fetch_image(image_hash) == ("application/octet-stream", b"\x89PNG\r\n\x1a\n")
+
+@pytest.mark.asyncio
+async def test_azure_storage_stages_large_blobs(monkeypatch):
+    class FakeBlobClient:
+        def __init__(self):
+            self.blocks = {}
+            self.committed = None
+        async def stage_block(self, block_id, data, length):
+            self.blocks[block_id] = bytes(data)
+        async def commit_block_list(self, block_list, content_settings):
+            self.committed = b"".join(self.blocks[block.id] for block in block_list)
+    class FakeContainerClient:
+        def __init__(self):
+            self.blob_client = FakeBlobClient()
+        def get_blob_client(self, blob):
+            return self.blob_client
+    monkeypatch.setenv("BLOB_BLOCK_SIZE", "4")
+    storage = AzureBlobStorage()
+    storage._container_client = FakeContainerClient()
+    await storage.upload("large", b"0123456789", "image/png")
+    blob_client = storage._container_client.blob_client
+    assert list(blob_client.blocks.values()) == [b"0123", b"4567", b"89"]
+    assert blob_client.committed == b"0123456789"
+
+@pytest.mark.asyncio
+async def test_sweep_orphaned_images(client, create_event, monkeypatch, make_event_input):
+    handler = app.get_azure_blob_handler()
+    storage = MemoryBlobStorage()
+    monkeypatch.setattr(handler, "storage", storage)
+    monkeypatch.setattr(handler, "known_blobs", {})
+    monkeypatch.setattr(handler, "gc_grace_period", timedelta(0))
+    first, second = (hashlib.sha256(image.encode('utf-8')).hexdigest() for image in ["first.jpg", "second.jpg"])
+    event_input = make_event_input(datetime="2030-08-02T12:00:00", image="first.jpg")
+    data, headers = create_event("sweep@example.com", event_input)
+    event_id = data["data"]["createEvent"]["id"]
+    assert await storage.exists(f"{first}.ref.event-{event_id}")
+
+    mutation = f'mutation {{ editEvent(input: {{id: {event_id}, image: "second.jpg"}}) {{ ... on Event {{ id }} }} }}'
+    assert client.post("/graphql", json={"query": mutation}, headers=headers).status_code == 200
+    report = await handler.sweep(app.images_in_use)
+    assert report["deleted_images"] == 1
+    # the thumbnail of an image it would not shrink is an empty marker
+    assert report["reclaimed_bytes"] == len(b"first.jpg")
+    assert not await storage.exists(first)
+    assert await storage.exists(second)
+
+    mutation = f'mutation {{ deleteEvent(id: {event_id}) {{ ... on Success {{ success }} }} }}'
+    assert client.post("/graphql", json={"query": mutation}, headers=headers).status_code == 200
+    await handler.sweep(app.images_in_use)
+    assert [blob.name async for blob in storage.list_blobs()] == []
+    # a grace period keeps released images
+    await storage.upload(first, b"first.jpg", "image/jpeg")
+    monkeypatch.setattr(handler, "gc_grace_period", timedelta(hours=1))
+    assert (await handler.sweep(app.images_in_use))["orphaned"] == 0
+
+@pytest.mark.asyncio
+async def test_images_in_use_are_never_swept(client, create_event, monkeypatch, make_event_input, tmp_path):
+    handler = app.get_azure_blob_handler()
+    storage = MemoryBlobStorage()
+    monkeypatch.setattr(handler, "storage", storage)
+    monkeypatch.setattr(handler, "known_blobs", {})
+    monkeypatch.setattr(handler, "gc_grace_period", timedelta(hours=1))
+    image_hash = hashlib.sha256(b"kept.jpg").hexdigest()
+    event_input = make_event_input(datetime="2030-08-02T12:00:00", image="kept.jpg")
+    data, _ = create_event("kept@example.com", event_input)
+    event_id = data["data"]["createEvent"]["id"]
+    # a profile picture the backfill never recorded, in the user service database
+    profile_hash = await handler.upload_blob("profile.jpg")
+    users_database = f"sqlite+aiosqlite:///{tmp_path / 'users.db'}"
+    engine = create_async_engine(users_database)
+    async with engine.begin() as connection:
+        await connection.execute(text("CREATE TABLE user_profiles (id INTEGER PRIMARY KEY, image TEXT)"))
+        await connection.execute(text("INSERT INTO user_profiles (id, image) VALUES (7, :image)"), {"image": profile_hash})
+    await engine.dispose()
+    in_use = blob_references.combined_in_use(
+        app.images_in_use,
+        blob_references.database_in_use(users_database, "user_profiles", "user"),
+    )
+    # the marker is lost and the image outlived the grace period
+    await storage.delete(f"{image_hash}.ref.event-{event_id}")
+    for name in storage.modified:
+        storage.modified[name] = datetime.now(timezone.utc) - timedelta(days=1)
+    async def nothing_in_use(image_hashes):
+        return []
+    assert (await handler.sweep(nothing_in_use, dry_run=True))["orphaned"] == 2
+    report = await handler.sweep(in_use)
+    assert report["orphaned"] == 0 and report["restored_references"] == 2
+    assert await storage.exists(image_hash)
+    assert await storage.exists(f"{image_hash}.ref.event-{event_id}")
+    assert await storage.exists(profile_hash)
+    assert await storage.exists(f"{profile_hash}.ref.user-7")
+
+    # uploading a released image again restarts its grace period
+    await storage.delete(f"{image_hash}.ref.event-{event_id}")
+    for name in storage.modified:
+        storage.modified[name] = datetime.now(timezone.utc) - timedelta(days=1)
+    assert await handler.upload_blob("kept.jpg") == image_hash
+    assert (await handler.sweep(nothing_in_use))["orphaned"] == 0
+
+@pytest.mark.asyncio
+async def test_failed_reference_writes(client, create_event, monkeypatch, make_event_input):
+    handler = app.get_azure_blob_handler()
+    storage = MemoryBlobStorage()
+    attempts = []
+    upload = storage.upload
+    async def failing_upload(name, data, content_type):
+        if ".ref." in name:
+            attempts.append(name)
+            raise OSError("storage unavailable")
+        await upload(name, data, content_type)
+    storage.upload = failing_upload
+    monkeypatch.setattr(handler, "storage", storage)
+    monkeypatch.setattr(handler, "known_blobs", {})
+    monkeypatch.setattr(handler, "reference_attempts", 2)
+    image_hash = hashlib.sha256(b"unreferenced.jpg").hexdigest()
+    # a created event is committed, the sweeper finds its image in the database
+    data, headers = create_event("unreferenced@example.com", make_event_input(image="unreferenced.jpg"))
+    event_id = data["data"]["createEvent"]["id"]
+    assert len(attempts) == 2
+    assert [image_hash, f"event-{event_id}"] in [list(reference) for reference in await app.images_in_use([image_hash])]
+
+    # an edit is refused before it changes the event
+    mutation = f'mutation {{ editEvent(input: {{id: {event_id}, image: "other.jpg"}}) {{ ... on Event {{ image }} }} }}'
+    data = client.post("/graphql", json={"query": mutation}, headers=headers).json()
+    assert data["data"] is None and data["errors"]
+    assert len(attempts) == 4
+    async with get_session() as db:
+        event = (await db.execute(select(EventTable).where(EventTable.id == event_id))).scalars().one()
+    assert event.image == image_hash
+
+@pytest.mark.asyncio
+async def test_download_timeouts_hedging_and_breaker(monkeypatch):
+    class SlowStorage(MemoryBlobStorage):
+        def __init__(self, delays):
+            super().__init__()
+            self.delays = delays
+            self.calls = 0
+        async def download(self, name):
+            delay = self.delays[min(self.calls, len(self.delays) - 1)]
+            self.calls += 1
+            await asyncio.sleep(delay)
+            return await super().download(name)
+    monkeypatch.setenv("BLOB_FETCH_TIMEOUT_SECONDS", "0.05")
+    monkeypatch.setenv("BLOB_BREAKER_FAILURES", "2")
+    monkeypatch.setenv("BLOB_HEDGE_AFTER_SECONDS", "0.01")
+    # the first request stalls, the hedged second one answers
+    storage = SlowStorage([10, 0])
+    await storage.upload("a" * 64, b"aaaaaa", "image/png")
+    handler = AzureBlobHandler("shared/azure/images/default-event.jpg", storage=storage)
+    handler.cache = type(handler.cache)(None, 1024 * 1024, 0)
+    assert await handler.fetch_image("a" * 64) == ("image/png", b"aaaaaa")
+    assert handler.stats()["hedged"] == 1
+
+    monkeypatch.delenv("BLOB_HEDGE_AFTER_SECONDS")
+    storage = SlowStorage([10])
+    await storage.upload("a" * 64, b"aaaaaa", "image/png")
+    handler = AzureBlobHandler("shared/azure/images/default-event.jpg", storage=storage)
+    handler.cache = type(handler.cache)(None, 1024 * 1024, 0)
+    started = time.monotonic()
+    assert await handler.get_blob("a" * 64) == handler.default_image
+    assert await handler.get_blob("a" * 64) == handler.default_image
+    assert handler.stats()["timeouts"] == 2
+    assert handler.stats()["state"] == "open"
+    # served the default without asking the storage
+    assert await handler.get_blob("a" * 64) == handler.default_image
+    assert storage.calls == 2
+    assert time.monotonic() - started < 1
+
+@pytest.mark.asyncio
+async def test_rabbit_producer_batches_and_retries():
+    class FakeExchange:
+        def __init__(self):
+            self.published = []
+            self.failures = 1
+        async def publish(self, message, routing_key):
+            assert message.delivery_mode == DeliveryMode.PERSISTENT
+            await asyncio.sleep(0)
+            if message.body == b"2" and self.failures:
+                self.failures -= 1
+                raise ConnectionError("nack")
+            self.published.append(message.body.decode('utf-8'))
+    class FakeChannel:
+        default_exchange = FakeExchange()
+    class FakeQueue:
+        name = "db-synchronise"
+    producer = RabbitProducer()
+    producer.batch_size = 3
+    # buffered before the connection is up
+    await producer.send_message("1")
+    producer.channel, producer.queue = FakeChannel(), FakeQueue()
+    producer.start()
+    for message in ["2", "3", "4"]:
+        await producer.send_message(message)
+    await producer.close()
+    # the batch from the nacked message onwards is published again in order
+    assert FakeChannel.default_exchange.published == ["1", "3", "2", "3", "4"]
+    assert producer.stats() == {"pending": 0, "published": 4, "retried": 1, "dropped": 0}
+
+def test_image_format_round_trip():
+    data_url = "data:image/png;base64,iVBORw0KGgo="
+    content_type, body = decode_data_url(data_url)
+    assert (content_type, body) == ("image/png", b"\x89PNG\r\n\x1a\n")
+    assert encode_data_url(content_type, body) == data_url
+    # anything that is not a data URL is kept as is
+    assert decode_data_url("testimage.jpg") == (VERBATIM, b"testimage.jpg")
+    assert encode_data_url(VERBATIM, b"testimage.jpg") == "testimage.jpg"
+    # the uploaded type is kept, image_response restricts what is served
+    assert decode_data_url("data:text/html;base64,PHNjcmlwdD4=")[0] == "text/html"
+    assert decode_data_url("data:Image/SVG+XML,<svg/>")[0] == "Image/SVG+XML"
+    # unless it would break the line based storage formats
+    for content_type in ["image/pn\ng", "imagé/png", "image/\u212aey"]:
+        assert decode_data_url(f"data:{content_type};base64,iVBORw0KGgo=")[0] == "application/octet-stream"
+
+@pytest.mark.asyncio
+async def test_get_image_by_hash(client, create_event, get_events_page, monkeypatch, make_event_input):
+    handler = app.get_azure_blob_handler()
+    response = client.get(f"/images/{handler.default_image_hash}")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/jpeg"
+    assert response.headers["etag"] == f'"{handler.default_image_hash}"'
+    assert "immutable" in response.headers["cache-control"]
+    assert response.content.startswith(b"\xff\xd8")
+    assert response.headers["x-content-type-options"] == "nosniff"
+    assert "sandbox" in response.headers["content-security-policy"]
+
+    response = client.get(f"/images/{handler.default_image_hash}", headers={"If-None-Match": f'"{handler.default_image_hash}"'})
+    assert response.status_code == 304
+    assert client.get("/images/not-a-hash").status_code == 404
+
+    # uploaded images are served from the storage, by their real hashes
+    monkeypatch.setattr(handler, "storage", MemoryBlobStorage())
+    monkeypatch.setattr(handler, "cache", BlobCache(None, 1024 * 1024, 0))
+    monkeypatch.setattr(handler, "known_blobs", {})
+    output = BytesIO()
+    Image.new("RGB", (1600, 900), "red").save(output, format="PNG")
+    png = output.getvalue()
+    image = "data:image/png;base64," + base64.b64encode(png).decode('ascii')
+    image_hash = hashlib.sha256(image.encode('utf-8')).hexdigest()
+    event_input = make_event_input(name="Image Url Event", image=image)
+    _, headers = create_event("imageurls@example.com", event_input)
+    # listings return image URLs once opted in
+    monkeypatch.setattr(handler, "serve_image_urls", True)
+    page = get_events_page(headers, 10, fields="image")
+    assert page["edges"][0]["edge"]["image"] == f"/images/{image_hash}/thumbnail"
+
+    response = client.get(f"/images/{image_hash}")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/png"
+    assert response.content == png
+    response = client.get(f"/images/{image_hash}/thumbnail")
+    assert response.status_code == 200
+    assert response.headers["etag"] == f'"{image_hash}-thumbnail"'
+    assert len(response.content) < len(png)
+    response = client.get(f"/images/{handler.default_image_hash}/thumbnail")
+    assert response.status_code == 200
+    assert len(response.content) < len(handler.default_image_entry[1])
+
+    # types a browser could run are stored as uploaded and served as opaque bytes
+    script = "data:text/html;base64," + base64.b64encode(b"<script>alert(1)</script>").decode('ascii')
+    create_event("imageurls@example.com", {**event_input, "name": "Script Event", "image": script})
+    script_hash = hashlib.sha256(script.encode('utf-8')).hexdigest()
+    assert await handler.fetch_image(script_hash) == ("text/html", b"<script>alert(1)</script>")
+    response = client.get(f"/images/{script_hash}")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/octet-stream"
+    assert response.headers["x-content-type-options"] == "nosniff"
+    assert response.content == b"<script>alert(1)</script>"
+
+    response = image_response(("Image/SVG+XML", b"<svg/>"), {})
+    assert response.media_type == "application/octet-stream"
+    assert image_response(("Image/PNG", png), {}).media_type == "image/png"
+    assert response.headers["x-content-type-options"] == "nosniff"
+
+def test_make_thumbnail():
+    output = BytesIO()
+    Image.new("RGB", (1600, 900), "red").save(output, format="PNG")
+    content_type, body = make_thumbnail("image/png", output.getvalue())
+    assert content_type in ("image/webp", "image/jpeg")
+    assert max(Image.open(BytesIO(body)).size) == THUMBNAIL_SIZE
+    # anything that is not an image, or would not get smaller, has no thumbnail
+    assert make_thumbnail("text/plain", b"not an image") is None
+    output = BytesIO()
+    Image.new("RGB", (1, 1), "red").save(output, format="GIF")
+    assert make_thumbnail("image/gif", output.getvalue()) is None
+
+def test_make_thumbnail_refuses_decompression_bombs(monkeypatch):
+    output = BytesIO()
+    Image.new("RGB", (1600, 900), "red").save(output, format="PNG")
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 1000)
+    assert make_thumbnail("image/png", output.getvalue()) is None
+
+@pytest.mark.asyncio
+async def test_blob_loader_dedupes_per_tick():
+    batches = []
+    loads = []
+
+    async def load(image_hash):
+        loads.append(image_hash)
+        await asyncio.sleep(0)
+        if image_hash == "broken":
+            raise ValueError(image_hash)
+        return f"image {image_hash}"
+
+    loader = BlobLoader(load)
+    original_dispatch = loader.dispatch
+    def dispatch():
+        batches.append(list(loader.queue))
+        original_dispatch()
+    loader.dispatch = dispatch
+
+    images = await loader.load_many(["a", "b", "a", None, "a"])
+    assert images == ["image a", "image b", "image a", "image None", "image a"]
+    assert batches == [["a", "b", None]]
+    assert await loader.load_many(["b", "c"]) == ["image b", "image c"]
+    assert loads == ["a", "b", None, "c"]
+    with pytest.raises(ValueError):
+        await loader.load("broken")
+
+@pytest.mark.asyncio
+async def test_get_events_loads_images_only_when_selected(create_event, get_events_page, monkeypatch, make_event_input):
+    handler = app.get_azure_blob_handler()
+    monkeypatch.setattr(handler, "storage", MemoryBlobStorage())
+    monkeypatch.setattr(handler, "cache", BlobCache(None, 1024 * 1024, 0))
+    monkeypatch.setattr(handler, "known_blobs", {})
+    image_hash = hashlib.sha256(b"testimage.jpg").hexdigest()
+    headers = None
+    for i in range(3):
+        _, headers = create_event("lazyimages@example.com", make_event_input(name=f"Lazy Image Event {i}", datetime=f"2099-08-0{i + 1}T12:00:00"))
+    loaded = []
+    get_thumbnail = handler.get_thumbnail
+    async def counting_get_thumbnail(image_hash):
+        loaded.append(image_hash)
+        return await get_thumbnail(image_hash)
+    monkeypatch.setattr(handler, "get_thumbnail", counting_get_thumbnail)
+
+    assert len(get_events_page(headers, 10, fields="name datetime")["edges"]) == 3
+    assert loaded == []
+    # the events share an image, which is loaded once for the response
+    edges = get_events_page(headers, 10, fields="name image")["edges"]
+    assert [edge["edge"]["image"] for edge in edges] == ["testimage.jpg"] * 3
+    assert loaded == [image_hash]
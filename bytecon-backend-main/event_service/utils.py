@@ -1,7 +1,13 @@
     
 
 import base64
-from api.schema import Tags
+import binascii
+from datetime import datetime, timedelta
+import heapq
+from operator import attrgetter
+import struct
+from typing import Any, TypeVar
+from api.schema import Cursor, DatetimeCursor, Event, EventPyModel, SearchCursor, TagsCursor
 
 
 def edit_distance(event_name: str, search: str) -> int:
@@ -23,9 +29,169 @@ def edit_distance(event_name: str, search: str) -> int:
     return dp[0][0]
 
 
-def tag_relevance(event_tags: list[Tags], search_tags: list[Tags]) -> int:
-    stored_tags, tags_set = set(event_tags), set(search_tags)
-    return len(stored_tags & tags_set)
+def bounded_edit_distance(event_name: str, search: str, max_distance: int | None = None) -> int | None:
+    """Bit-parallel (Myers/Hyyro) version of edit_distance.
 
-def b64_encode(input: str):
-    return base64.b64encode(input.encode()).decode()
\ No newline at end of file
+    Returns the same distance as edit_distance, or None as soon as the
+    distance is known to be greater than max_distance.
+    """
+    event_name, search = event_name.lower(), search.lower()
+    if len(search) > len(event_name):
+        event_name, search = search, event_name
+    text_len, pattern_len = len(event_name), len(search)
+    if max_distance is not None and text_len - pattern_len > max_distance:
+        return None
+    if pattern_len == 0:
+        return text_len
+
+    peq: dict[str, int] = {}
+    for i, char in enumerate(search):
+        peq[char] = peq.get(char, 0) | (1 << i)
+
+    mask = (1 << pattern_len) - 1
+    high_bit = 1 << (pattern_len - 1)
+    pv, mv, score = mask, 0, pattern_len
+    for j, char in enumerate(event_name):
+        eq = peq.get(char, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+        if ph & high_bit:
+            score += 1
+        elif mh & high_bit:
+            score -= 1
+        # the score can drop by at most one per remaining character
+        if max_distance is not None and score - (text_len - j - 1) > max_distance:
+            return None
+        ph = ((ph << 1) | 1) & mask
+        mh = (mh << 1) & mask
+        pv = mh | (~(xv | ph) & mask)
+        mv = ph & xv
+    return score
+
+
+class TopK:
+    """Streaming selection of the k items with the smallest (score, id).
+
+    Keeps a bounded max-heap so memory stays O(k) however many rows are
+    pushed. With k=None every item is kept.
+    """
+
+    def __init__(self, k: int | None):
+        self.k = k
+        self.heap: list[tuple[int, int, Any]] = []
+
+    def threshold(self) -> int | None:
+        """Worst score still selected once k items are held, else None."""
+        if self.k is None or len(self.heap) < self.k:
+            return None
+        return -self.heap[0][0]
+
+    def push(self, score: int, id: int, item: Any) -> None:
+        entry = (-score, -id, item)
+        if self.k is None or len(self.heap) < self.k:
+            heapq.heappush(self.heap, entry)
+        elif entry[:2] > self.heap[0][:2]:
+            heapq.heapreplace(self.heap, entry)
+
+    def items(self) -> list[tuple[Any, int]]:
+        """Selected (item, score) pairs ordered by (score, id)."""
+        return [(item, -score) for score, _, item in sorted(self.heap, key=lambda entry: entry[:2], reverse=True)]
+
+
+# Compact cursors are a version byte, a strategy tag and a struct packed
+# payload, in URL-safe base64 without padding. Cursors from before the
+# compact format are base64 encoded JSON and are still accepted.
+CURSOR_VERSION = 1
+_CURSOR_HEADER = struct.Struct(">Bc")
+_SEARCH_CURSOR = struct.Struct(">qI")
+_SNAPSHOT = struct.Struct(">qI")
+_TAGS_CURSOR = struct.Struct(">qI")
+_DATETIME_CURSOR = struct.Struct(">qq")
+_ID_CURSOR = struct.Struct(">q")
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+CursorT = TypeVar("CursorT", SearchCursor, TagsCursor, DatetimeCursor, Cursor)
+
+def _pack_cursor(tag: bytes, payload: bytes) -> str:
+    return base64.urlsafe_b64encode(_CURSOR_HEADER.pack(CURSOR_VERSION, tag) + payload).rstrip(b"=").decode()
+
+def encode_search_cursor(id: int, relevance: int, snapshot: int | None = None, offset: int | None = None) -> str:
+    payload = _SEARCH_CURSOR.pack(id, relevance)
+    if snapshot is not None:
+        payload += _SNAPSHOT.pack(snapshot, offset or 0)
+    return _pack_cursor(b"S", payload)
+
+def encode_tags_cursor(id: int, matching_tags: int) -> str:
+    return _pack_cursor(b"T", _TAGS_CURSOR.pack(id, matching_tags))
+
+def encode_datetime_cursor(id: int, event_datetime: datetime) -> str:
+    # datetimes are stored naive, so are cursors
+    micros = (event_datetime.replace(tzinfo=None) - _EPOCH) // _MICROSECOND
+    return _pack_cursor(b"D", _DATETIME_CURSOR.pack(id, micros))
+
+def encode_id_cursor(id: int) -> str:
+    return _pack_cursor(b"C", _ID_CURSOR.pack(id))
+
+def _unpack_search_cursor(payload: bytes) -> SearchCursor:
+    id, relevance = _SEARCH_CURSOR.unpack_from(payload)
+    if len(payload) == _SEARCH_CURSOR.size:
+        return SearchCursor.model_construct(id=id, relevance=relevance, snapshot=None, offset=None)
+    snapshot, offset = _SNAPSHOT.unpack(payload[_SEARCH_CURSOR.size:])
+    return SearchCursor.model_construct(id=id, relevance=relevance, snapshot=snapshot, offset=offset)
+
+def _unpack_tags_cursor(payload: bytes) -> TagsCursor:
+    id, matching_tags = _TAGS_CURSOR.unpack(payload)
+    return TagsCursor.model_construct(id=id, matching_tags=matching_tags)
+
+def _unpack_datetime_cursor(payload: bytes) -> DatetimeCursor:
+    id, micros = _DATETIME_CURSOR.unpack(payload)
+    return DatetimeCursor.model_construct(id=id, datetime=_EPOCH + micros * _MICROSECOND)
+
+def _unpack_id_cursor(payload: bytes) -> Cursor:
+    (id,) = _ID_CURSOR.unpack(payload)
+    return Cursor.model_construct(id=id)
+
+_CURSOR_CODECS = {
+    SearchCursor: (b"S", _unpack_search_cursor),
+    TagsCursor: (b"T", _unpack_tags_cursor),
+    DatetimeCursor: (b"D", _unpack_datetime_cursor),
+    Cursor: (b"C", _unpack_id_cursor),
+}
+
+def decode_cursor(after: str, cursor_type: type[CursorT]) -> CursorT:
+    """Decode a compact or legacy JSON cursor, raising ValueError if it is invalid."""
+    tag, unpack = _CURSOR_CODECS[cursor_type]
+    try:
+        data = base64.urlsafe_b64decode(after + "=" * (-len(after) % 4))
+    except (binascii.Error, ValueError):
+        data = b""
+    # legacy cursors decode to JSON, which never starts with the version byte
+    if len(data) >= _CURSOR_HEADER.size and data[0] == CURSOR_VERSION:
+        if data[1:2] != tag:
+            raise ValueError("Cursor belongs to a different filter")
+        try:
+            return unpack(data[_CURSOR_HEADER.size:])
+        except struct.error as e:
+            raise ValueError("Malformed cursor") from e
+    return cursor_type.model_validate_json(base64.b64decode(after))
+
+
+# Event fields read straight from EventTable columns, computed once
+EVENT_COLUMNS = tuple(field for field in EventPyModel.model_fields if field not in ("tags", "image"))
+_get_event_columns = attrgetter(*EVENT_COLUMNS)
+
+def event_to_graphql(event, thumbnail: bool = False, image: str | None = None) -> Event:
+    """Build the GraphQL Event for an EventTable row.
+
+    Rows come from our own database, so this skips the EventPyModel
+    validation that Event.from_pydantic would go through. The image is
+    only loaded if selected, as the thumbnail for listings, unless its
+    value is already known.
+    """
+    return Event(
+        **dict(zip(EVENT_COLUMNS, _get_event_columns(event))), tags=event.tags_list,
+        image_hash=event.image, image_data=image, thumbnail=thumbnail,
+    )
@@ -1,55 +1,334 @@
 from dotenv import load_dotenv
+import asyncio
 import base64
+from datetime import timedelta
 import os
 import hashlib
+import tempfile
+import time
+from typing import Iterable
 
-from azure.identity.aio import ClientSecretCredential
-from azure.storage.blob.aio import BlobServiceClient
+from shared.azure.blob_cache import BlobCache
+from shared.azure import blob_references
+from shared.azure.blob_storage import BlobNotFound, BlobStorage, create_blob_storage
+from shared.azure.circuit_breaker import CircuitBreaker, CircuitOpen
+from shared.azure.image_format import decode_data_url, encode_data_url
+from shared.azure.thumbnails import USE_ORIGINAL, make_thumbnail, thumbnail_name
 
 load_dotenv()
 
 class AzureBlobHandler:
-    def __init__(self, default_img_path):
-        client_id = os.environ['AZURE_CLIENT_ID']
-        tenant_id = os.environ['AZURE_TENANT_ID']
-        client_secret = os.environ['AZURE_CLIENT_SECRET']
-        self.account_url = os.environ["AZURE_STORAGE_URL"]
-        
-        self.credentials = ClientSecretCredential(
-            client_id=client_id, 
-            client_secret=client_secret,
-            tenant_id=tenant_id
+    def __init__(self, default_img_path, storage: BlobStorage | None = None):
+        # BLOB_STORAGE picks azure, local or memory when no storage is given
+        self.storage = storage or create_blob_storage()
+
+        # blobs are content addressed, so cached copies never go stale
+        cache_dir = os.getenv("BLOB_CACHE_DIR", os.path.join(tempfile.gettempdir(), "bytecon-blob-cache"))
+        self.cache = BlobCache(
+            cache_dir or None,
+            max_memory_bytes=int(os.getenv("BLOB_CACHE_MEMORY_BYTES", 64 * 1024 * 1024)),
+            max_disk_bytes=int(os.getenv("BLOB_CACHE_DISK_BYTES", 1024 * 1024 * 1024)),
         )
 
-        self.blob_service_client = BlobServiceClient(account_url=self.account_url, credential=self.credentials)
-        self.container_name = 'crashoutpicstorage'
-        self.container_client = self.blob_service_client.get_container_client(container=self.container_name)
+        # hashes known to be stored, so uploading the same image again is
+        # skipped, until they expire well before the sweeper could delete them
+        self.known_blobs: dict[str, float] = {}
+        self.max_known_blobs = int(os.getenv("BLOB_KNOWN_HASHES", 100_000))
+        self.known_blobs_ttl = int(os.getenv("BLOB_KNOWN_TTL_SECONDS", 3600))
+
+        # unreferenced images are swept once unchanged for the grace period
+        self.gc_grace_period = timedelta(seconds=int(os.getenv("BLOB_GC_GRACE_SECONDS", 24 * 60 * 60)))
+        self.gc_batch_size = int(os.getenv("BLOB_GC_BATCH_SIZE", 100))
+        self.gc_deletes_per_second = float(os.getenv("BLOB_GC_DELETES_PER_SECOND", 50))
+        self.last_sweep: dict[str, int] = {}
+        # a mutation fails rather than use an image without a reference
+        self.reference_attempts = int(os.getenv("BLOB_REFERENCE_ATTEMPTS", 3))
+
+        # caps concurrent downloads across all requests of the service
+        self.max_downloads = int(os.getenv("BLOB_MAX_DOWNLOADS", 16))
+        self.download_semaphore: asyncio.Semaphore | None = None
+
+        # bounds how long one slow blob can hold up a page, including queueing
+        # for the semaphore, and optionally sends a second request for it
+        self.fetch_timeout = float(os.getenv("BLOB_FETCH_TIMEOUT_SECONDS", 2))
+        hedge_after = os.getenv("BLOB_HEDGE_AFTER_SECONDS")
+        self.hedge_after = float(hedge_after) if hedge_after else None
+        self.fetch_stats = {"timeouts": 0, "hedged": 0}
+        # while storage keeps failing, images fall back to the default at once
+        self.breaker = CircuitBreaker(
+            failure_threshold=int(os.getenv("BLOB_BREAKER_FAILURES", 5)),
+            reset_timeout=float(os.getenv("BLOB_BREAKER_RESET_SECONDS", 30)),
+        )
+
+        # opt in to returning /images URLs from GraphQL instead of inline data URLs
+        self.serve_image_urls = os.getenv("IMAGE_URLS", "false").lower() in ("1", "true")
+        self.image_url_base = os.getenv("IMAGE_URL_BASE", "").rstrip("/")
 
         with open(default_img_path, "rb") as image_file:
             encoded_string = base64.b64encode(image_file.read())
             self.default_image = "data:image/jpeg;base64," + encoded_string.decode('utf-8')
             self.default_image_hash = hashlib.sha256(self.default_image.encode('utf-8')).hexdigest()
+            self.default_image_entry = decode_data_url(self.default_image)
+            self.default_thumbnail: tuple[str, bytes] | None = None
 
     async def upload_blob(self, base64_str: str | None) -> str:
         if base64_str is None:
             return self.default_image_hash
+        # the hash stays that of the uploaded string, the blob holds the raw bytes
         image_hash = hashlib.sha256(base64_str.encode('utf-8')).hexdigest()
+        if await self.is_stored(image_hash) and await self.restart_grace_period(image_hash):
+            return image_hash
         try:
-            await self.container_client.upload_blob(name=f"{image_hash}.txt", data=base64_str, overwrite=True) 
+            content_type, body = decode_data_url(base64_str)
+        except ValueError as e:
+            print(f"Error while decoding image: {e}")
+            return self.default_image_hash
+        try:
+            await self.storage.upload(image_hash, body, content_type)
         except Exception as e:
             print(f"Error while uploading image: {e}")
             return self.default_image_hash
+        self.remember_stored(image_hash)
+        await self.cache.set(image_hash, content_type, body)
+        await self.store_thumbnail(image_hash, content_type, body)
         return image_hash
 
-    async def get_blob(self, image_hash: str | None) -> str:
-        if image_hash is None or image_hash == self.default_image_hash:
-            return self.default_image
-        blob_name = f"{image_hash}.txt"
-        blob_client = self.container_client.get_blob_client(blob=blob_name)
+    def remember_stored(self, image_hash: str) -> None:
+        if len(self.known_blobs) >= self.max_known_blobs:
+            self.known_blobs.clear()
+        self.known_blobs[image_hash] = time.monotonic() + self.known_blobs_ttl
+
+    async def is_stored(self, image_hash: str) -> bool:
+        """Whether an image is already stored, checking the storage on a miss of the local index."""
+        if image_hash == self.default_image_hash or self.known_blobs.get(image_hash, 0) > time.monotonic():
+            return True
+        try:
+            stored = await self.storage.exists(image_hash)
+        except Exception as e:
+            print(f"Error checking for image: {e}")
+            return False
+        if stored:
+            self.remember_stored(image_hash)
+        return stored
+
+    async def restart_grace_period(self, image_hash: str) -> bool:
+        """Keep a stored image from being swept before it is referenced again, returning whether it was."""
+        if image_hash == self.default_image_hash:
+            return True
+        try:
+            await blob_references.restart_grace_period(self.storage, image_hash)
+            return True
+        except Exception as e:
+            print(f"Error restarting image grace period: {e}")
+            return False
+
+    async def add_reference(self, image_hash: str | None, owner: str) -> None:
+        """Record that owner, such as event-1 or user-1, uses the image.
+
+        Failed writes are retried, and the last failure is raised, so the
+        caller does not commit a use of the image the sweeper cannot see.
+        """
+        if not image_hash or image_hash == self.default_image_hash:
+            return
+        for attempt in range(self.reference_attempts):
+            try:
+                await blob_references.add_reference(self.storage, image_hash, owner)
+                return
+            except Exception as e:
+                if attempt == self.reference_attempts - 1:
+                    raise
+                print(f"Error adding image reference, retrying: {e}")
+                await asyncio.sleep(0.1 * 2 ** attempt)
+
+    async def remove_reference(self, image_hash: str | None, owner: str) -> None:
+        if not image_hash or image_hash == self.default_image_hash:
+            return
+        try:
+            await blob_references.remove_reference(self.storage, image_hash, owner)
+        except Exception as e:
+            print(f"Error removing image reference: {e}")
+
+    async def backfill_references(self, references: Iterable[tuple[str | None, str]]) -> None:
+        """Record references of (hash, owner) pairs that predate the reference index."""
+        try:
+            added = await blob_references.backfill_references(
+                self.storage,
+                ((image_hash, owner) for image_hash, owner in references if image_hash and image_hash != self.default_image_hash),
+            )
+            print(f"Backfilled {added} image references")
+        except Exception as e:
+            print(f"Error backfilling image references: {e}")
+
+    async def sweep(self, in_use: blob_references.InUse, protected: Iterable[str] = (), dry_run: bool = False) -> dict[str, int]:
+        """Delete unreferenced images older than the grace period, see blob_references."""
+        self.last_sweep = await blob_references.sweep_orphaned_blobs(
+            self.storage,
+            self.gc_grace_period,
+            in_use,
+            protected=[self.default_image_hash, *protected],
+            batch_size=self.gc_batch_size,
+            deletes_per_second=self.gc_deletes_per_second,
+            dry_run=dry_run,
+        )
+        return self.last_sweep
+
+    async def run_sweeper(self, interval: float, in_use: blob_references.InUse) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                report = await self.sweep(in_use)
+                print(f"Swept orphaned images: {report}")
+            except Exception as e:
+                print(f"Error sweeping orphaned images: {e}")
+
+    async def store_thumbnail(self, image_hash: str, content_type: str, body: bytes) -> tuple[str, bytes]:
+        thumbnail = await asyncio.to_thread(make_thumbnail, content_type, body)
+        name = thumbnail_name(image_hash)
+        # an empty marker rather than a second copy of the image
+        stored = thumbnail or (USE_ORIGINAL, b"")
+        try:
+            await self.storage.upload(name, stored[1], stored[0])
+        except Exception as e:
+            print(f"Error while uploading thumbnail: {e}")
+        await self.cache.set(name, *stored)
+        return thumbnail or (content_type, body)
+
+    async def download_blob(self, name: str) -> tuple[str, bytes]:
+        """Download a blob within the fetch timeout, raising CircuitOpen while storage is failing."""
+        if not self.breaker.allow():
+            raise CircuitOpen(name)
+        try:
+            entry = await asyncio.wait_for(self.hedged_download(name), self.fetch_timeout)
+        except BlobNotFound:
+            # storage answered, so it is healthy
+            self.breaker.record_success()
+            raise
+        except asyncio.TimeoutError:
+            self.fetch_stats["timeouts"] += 1
+            self.breaker.record_failure()
+            raise
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        return entry
+
+    async def limited_download(self, name: str) -> tuple[str, bytes]:
+        if self.download_semaphore is None:
+            self.download_semaphore = asyncio.Semaphore(self.max_downloads)
+        async with self.download_semaphore:
+            return await self.storage.download(name)
+
+    async def hedged_download(self, name: str) -> tuple[str, bytes]:
+        """Download a blob, sending a second request when the first is slower than hedge_after."""
+        if self.hedge_after is None:
+            return await self.limited_download(name)
+        pending = {asyncio.ensure_future(self.limited_download(name))}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=self.hedge_after)
+            if done:
+                return done.pop().result()
+            self.fetch_stats["hedged"] += 1
+            pending.add(asyncio.ensure_future(self.limited_download(name)))
+            error: BaseException | None = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    error = task.exception()
+                    # a missing blob is missing for the other request too
+                    if error is None or isinstance(error, BlobNotFound):
+                        return task.result()
+            raise error # type: ignore
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def download_image(self, image_hash: str) -> tuple[str, bytes]:
+        try:
+            return await self.download_blob(image_hash)
+        except BlobNotFound:
+            # uploaded as a data URL string before the binary format, see migrate_blobs
+            _, body = await self.download_blob(f"{image_hash}.txt")
+            return decode_data_url(body.decode('utf-8'))
+
+    async def fetch_image(self, image_hash: str) -> tuple[str, bytes] | None:
+        """Return the content type and bytes of a stored image, or None when it cannot be downloaded."""
+        if image_hash == self.default_image_hash:
+            return self.default_image_entry
+        cached = await self.cache.get(image_hash)
+        if cached is not None:
+            return cached
         try:
-            download = await blob_client.download_blob()
-            data = await download.readall()
-            return data.decode()
+            content_type, body = await self.download_image(image_hash)
+        except CircuitOpen:
+            return None
         except Exception as e:
             print("Error downloading blob, returning default blob")
-        return self.default_image
+            return None
+        self.remember_stored(image_hash)
+        await self.cache.set(image_hash, content_type, body)
+        return content_type, body
+
+    async def fetch_thumbnail(self, image_hash: str) -> tuple[str, bytes] | None:
+        """Like fetch_image, for the thumbnail, which is generated if it was never stored."""
+        if image_hash == self.default_image_hash:
+            if self.default_thumbnail is None:
+                self.default_thumbnail = await asyncio.to_thread(make_thumbnail, *self.default_image_entry) or self.default_image_entry
+            return self.default_thumbnail
+        name = thumbnail_name(image_hash)
+        entry = await self.cache.get(name)
+        try:
+            if entry is None:
+                entry = await self.download_blob(name)
+                await self.cache.set(name, *entry)
+            if entry[0] == USE_ORIGINAL:
+                return await self.fetch_image(image_hash)
+            return entry
+        except BlobNotFound:
+            pass
+        except CircuitOpen:
+            return None
+        except Exception as e:
+            print("Error downloading thumbnail, returning default blob")
+            return None
+        # images uploaded before thumbnails existed get one on first request
+        entry = await self.fetch_image(image_hash)
+        if entry is None:
+            return None
+        return await self.store_thumbnail(image_hash, *entry)
+
+    def stats(self) -> dict[str, int | str]:
+        return {**self.fetch_stats, **self.breaker.stats()}
+
+    async def fetch_blob(self, image_hash: str) -> str | None:
+        """Return the stored image as a data URL, or None when it cannot be downloaded."""
+        if image_hash == self.default_image_hash:
+            return self.default_image
+        entry = await self.fetch_image(image_hash)
+        return None if entry is None else encode_data_url(*entry)
+
+    async def get_blob(self, image_hash: str | None) -> str:
+        if not image_hash:
+            return self.default_image
+        data = await self.fetch_blob(image_hash)
+        return self.default_image if data is None else data
+
+    def image_url(self, image_hash: str | None) -> str:
+        return f"{self.image_url_base}/images/{image_hash or self.default_image_hash}"
+
+    async def get_image(self, image_hash: str | None) -> str:
+        """Value of a GraphQL image field, a URL when IMAGE_URLS is on, otherwise the data URL."""
+        if self.serve_image_urls:
+            return self.image_url(image_hash)
+        return await self.get_blob(image_hash)
+
+    async def get_thumbnail(self, image_hash: str | None) -> str:
+        """Like get_image, for the thumbnail shown in listings."""
+        if self.serve_image_urls:
+            return f"{self.image_url(image_hash)}/thumbnail"
+        entry = None
+        if image_hash:
+            entry = await self.fetch_thumbnail(image_hash)
+        if entry is None:
+            entry = await self.fetch_thumbnail(self.default_image_hash)
+        return encode_data_url(*entry) # type: ignore
@@ -0,0 +1,148 @@
+import asyncio
+from collections import OrderedDict
+import os
+import tempfile
+import threading
+
+DISK_FORMAT = "v2"
+
+class BlobCache:
+    """Two tier cache of downloaded images, keyed by their content hash.
+
+    Blobs are named by the SHA-256 hash of their content and never change,
+    so entries are never invalidated, only evicted. The first tier is an
+    in-memory LRU bounded by bytes, the second a directory of one file per
+    blob bounded by its total size, evicting the least recently read
+    files. Entries are (content type, bytes). Disk access runs in a worker
+    thread and is best-effort, a failing disk only loses its tier.
+    Services on the same host can share the directory.
+    """
+
+    def __init__(self, directory: str | None, max_memory_bytes: int, max_disk_bytes: int):
+        # files of other formats live in other subdirectories
+        self.directory = None if directory is None else os.path.join(directory, DISK_FORMAT)
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.memory: OrderedDict[str, tuple[str, bytes]] = OrderedDict()
+        self.memory_bytes = 0
+        self.disk_bytes: int | None = None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.memory_evictions = 0
+        self.disk_evictions = 0
+        self.disk_errors = 0
+        self._disk_lock = threading.Lock()
+        if self.directory is not None:
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+            except OSError as e:
+                print(f"Error creating blob cache directory, caching in memory only: {e}")
+                self.directory = None
+
+    async def get(self, image_hash: str) -> tuple[str, bytes] | None:
+        entry = self.memory.get(image_hash)
+        if entry is not None:
+            self.memory.move_to_end(image_hash)
+            self.memory_hits += 1
+            return entry
+        if self.directory is not None:
+            entry = await asyncio.to_thread(self._read_file, image_hash)
+            if entry is not None:
+                self.disk_hits += 1
+                self._remember(image_hash, entry)
+                return entry
+        self.misses += 1
+        return None
+
+    async def set(self, image_hash: str, content_type: str, body: bytes) -> None:
+        self._remember(image_hash, (content_type, body))
+        if self.directory is not None:
+            try:
+                await asyncio.to_thread(self._write_file, image_hash, content_type, body)
+            except (OSError, ValueError) as e:
+                self.disk_errors += 1
+                print(f"Error writing blob cache file: {e}")
+
+    def _remember(self, image_hash: str, entry: tuple[str, bytes]) -> None:
+        size = len(entry[1])
+        if size > self.max_memory_bytes:
+            return
+        previous = self.memory.pop(image_hash, None)
+        if previous is not None:
+            self.memory_bytes -= len(previous[1])
+        self.memory[image_hash] = entry
+        self.memory_bytes += size
+        while self.memory_bytes > self.max_memory_bytes:
+            _, (_, evicted) = self.memory.popitem(last=False)
+            self.memory_bytes -= len(evicted)
+            self.memory_evictions += 1
+
+    def _path(self, image_hash: str) -> str:
+        return os.path.join(self.directory, image_hash) # type: ignore
+
+    def _read_file(self, image_hash: str) -> tuple[str, bytes] | None:
+        path = self._path(image_hash)
+        try:
+            with open(path, "rb") as file:
+                content_type = file.readline().rstrip(b"\n").decode('ascii')
+                body = file.read()
+            # the modification time orders disk evictions
+            os.utime(path)
+            return content_type, body
+        except (OSError, UnicodeDecodeError):
+            return None
+
+    def _write_file(self, image_hash: str, content_type: str, body: bytes) -> None:
+        path = self._path(image_hash)
+        if os.path.exists(path):
+            return
+        # a content type line followed by the image bytes, written under a
+        # temporary name so readers never see partial files
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(content_type.encode('ascii') + b"\n")
+                file.write(body)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        with self._disk_lock:
+            if self.disk_bytes is None:
+                self.disk_bytes = sum(entry.stat().st_size for entry in os.scandir(self.directory) if entry.is_file())
+            else:
+                self.disk_bytes += os.path.getsize(path)
+            if self.disk_bytes > self.max_disk_bytes:
+                self._evict_files()
+
+    def _evict_files(self) -> None:
+        entries = sorted(
+            (entry.stat().st_mtime, entry.path, entry.stat().st_size)
+            for entry in os.scandir(self.directory) if entry.is_file() and not entry.name.startswith(".tmp-")
+        )
+        self.disk_bytes = sum(size for _, _, size in entries)
+        # evict down to 90% so that every write does not trigger a scan
+        target = self.max_disk_bytes * 0.9
+        for _, path, size in entries:
+            if self.disk_bytes <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.disk_bytes -= size
+            self.disk_evictions += 1
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "memory_entries": len(self.memory),
+            "memory_bytes": self.memory_bytes,
+            "disk_bytes": self.disk_bytes or 0,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "memory_evictions": self.memory_evictions,
+            "disk_evictions": self.disk_evictions,
+            "disk_errors": self.disk_errors,
+        }
@@ -0,0 +1,47 @@
+import asyncio
+from typing import Awaitable, Callable, Iterable
+
+
+class BlobLoader:
+    """Request scoped loader of image field values.
+
+    Loads requested in the same event loop tick are dispatched together,
+    each distinct key once, and every key is loaded at most once for the
+    lifetime of the loader. Downloads are capped by the handler's
+    download semaphore, which is shared across requests.
+    """
+
+    def __init__(self, load_fn: Callable[[str | None], Awaitable[str]]):
+        self.load_fn = load_fn
+        self.futures: dict[str | None, asyncio.Future[str]] = {}
+        self.queue: list[str | None] = []
+        self.tasks: set[asyncio.Task] = set()
+
+    def load(self, image_hash: str | None) -> asyncio.Future[str]:
+        future = self.futures.get(image_hash)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self.futures[image_hash] = future
+            self.queue.append(image_hash)
+            if len(self.queue) == 1:
+                loop.call_soon(self.dispatch)
+        return future
+
+    async def load_many(self, image_hashes: Iterable[str | None]) -> list[str]:
+        return list(await asyncio.gather(*(self.load(image_hash) for image_hash in image_hashes)))
+
+    def dispatch(self) -> None:
+        batch, self.queue = self.queue, []
+        for image_hash in batch:
+            task = asyncio.ensure_future(self.resolve(image_hash))
+            # keep a reference until done, the event loop only holds weak ones
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def resolve(self, image_hash: str | None) -> None:
+        future = self.futures[image_hash]
+        try:
+            future.set_result(await self.load_fn(image_hash))
+        except Exception as e:
+            future.set_exception(e)
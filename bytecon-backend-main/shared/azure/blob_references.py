@@ -0,0 +1,206 @@
+"""Reference index of stored images and the sweeper of orphaned ones.
+
+Images are named by their content hash, so editing or deleting the event
+or profile using one leaves the blob behind. Each use is recorded as an
+empty `{hash}.ref.{owner}` marker blob in the same storage, which every
+service shares, and releasing the last use writes a `{hash}.released`
+marker, which is written again when the image is uploaded again. The
+sweeper deletes the blobs of hashes without references once none of them
+changed for the grace period, which also covers uploads whose event was
+never saved. It first asks the events and user profile databases whether
+the image is still used, and refuses to run without both.
+
+Markers of images used before the index existed are written by the
+backfill, so run every service once with BLOB_REFERENCE_BACKFILL=true
+before the first sweep. The database check only catches the markers
+that are missing after that.
+
+    python -m shared.azure.blob_references --events-database URL --users-database URL [--dry-run] [--grace-seconds N]
+"""
+import argparse
+import asyncio
+from datetime import datetime, timedelta, timezone
+import os
+import re
+import time
+from typing import Awaitable, Callable, Iterable
+
+from sqlalchemy import bindparam, text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from shared.azure.blob_storage import BlobInfo, BlobStorage
+
+IMAGE_HASH = re.compile(r"[0-9a-f]{64}")
+REFERENCE = ".ref."
+RELEASED = ".released"
+# hashes looked up per database query
+IN_USE_CHUNK_SIZE = 500
+
+# returns the (hash, owner) references a database has to any of the hashes
+InUse = Callable[[list[str]], Awaitable[Iterable[tuple[str, str]]]]
+
+
+def reference_name(image_hash: str, owner: str) -> str:
+    return f"{image_hash}{REFERENCE}{owner}"
+
+
+async def add_reference(storage: BlobStorage, image_hash: str, owner: str) -> None:
+    await storage.upload(reference_name(image_hash, owner), b"", "text/plain")
+
+
+async def remove_reference(storage: BlobStorage, image_hash: str, owner: str) -> None:
+    await storage.delete(reference_name(image_hash, owner))
+    async for _ in storage.list_blobs(f"{image_hash}{REFERENCE}"):
+        return
+    # starts the grace period of an image that was in use for longer than it
+    await storage.upload(f"{image_hash}{RELEASED}", b"", "text/plain")
+
+
+async def restart_grace_period(storage: BlobStorage, image_hash: str) -> None:
+    """Keep an unreferenced image that is already stored from being swept before it is referenced."""
+    async for _ in storage.list_blobs(f"{image_hash}{REFERENCE}"):
+        return
+    await storage.upload(f"{image_hash}{RELEASED}", b"", "text/plain")
+
+
+async def backfill_references(storage: BlobStorage, references: Iterable[tuple[str, str]], concurrency: int = 16) -> int:
+    """Record (hash, owner) references made before the index existed, returning how many were added."""
+    existing = {blob.name async for blob in storage.list_blobs() if REFERENCE in blob.name}
+    missing = {reference_name(*reference) for reference in references} - existing
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def add(name: str) -> None:
+        async with semaphore:
+            await storage.upload(name, b"", "text/plain")
+
+    await asyncio.gather(*(add(name) for name in missing))
+    return len(missing)
+
+
+def database_in_use(url: str, table_name: str, owner_prefix: str) -> InUse:
+    """Look images up in the image column of a table, such as user_profiles of the user service."""
+    engine = create_async_engine(url)
+    statement = text(f"SELECT image, id FROM {table_name} WHERE image IN :hashes").bindparams(bindparam("hashes", expanding=True))
+
+    async def in_use(image_hashes: list[str]) -> list[tuple[str, str]]:
+        references = []
+        async with engine.connect() as connection:
+            for start in range(0, len(image_hashes), IN_USE_CHUNK_SIZE):
+                rows = await connection.execute(statement, {"hashes": image_hashes[start:start + IN_USE_CHUNK_SIZE]})
+                references.extend((image, f"{owner_prefix}-{id}") for image, id in rows)
+        return references
+
+    return in_use
+
+
+def combined_in_use(*checks: InUse) -> InUse:
+    async def in_use(image_hashes: list[str]) -> list[tuple[str, str]]:
+        return [reference for check in checks for reference in await check(image_hashes)]
+
+    return in_use
+
+
+async def sweep_orphaned_blobs(
+    storage: BlobStorage,
+    grace_period: timedelta,
+    in_use: InUse,
+    protected: Iterable[str] = (),
+    batch_size: int = 100,
+    deletes_per_second: float = 50,
+    dry_run: bool = False,
+) -> dict[str, int]:
+    """Delete the blobs of unreferenced images, returning counts and the bytes reclaimed.
+
+    Hashes in protected, such as the default images, are never deleted.
+    in_use must check every database that uses images. The images it
+    returns references for are kept and their markers restored.
+    """
+    protected = set(protected)
+    cutoff = datetime.now(timezone.utc) - grace_period
+    groups: dict[str, list[BlobInfo]] = {}
+    referenced: set[str] = set()
+    async for blob in storage.list_blobs():
+        image_hash = blob.name[:64]
+        # blobs not named after an image hash are left alone
+        if not IMAGE_HASH.fullmatch(image_hash) or image_hash in protected:
+            continue
+        if blob.name[64:].startswith(REFERENCE):
+            referenced.add(image_hash)
+        else:
+            groups.setdefault(image_hash, []).append(blob)
+    orphans = [
+        (image_hash, blobs) for image_hash, blobs in groups.items()
+        if image_hash not in referenced and max(blob.last_modified for blob in blobs) < cutoff
+    ]
+    restored = 0
+    if orphans:
+        # references whose marker was lost
+        references = list(await in_use([image_hash for image_hash, _ in orphans]))
+        used = {image_hash for image_hash, _ in references}
+        orphans = [(image_hash, blobs) for image_hash, blobs in orphans if image_hash not in used]
+        if not dry_run:
+            for image_hash, owner in references:
+                await add_reference(storage, image_hash, owner)
+        restored = len(references)
+    report = {
+        "images": len(groups), "orphaned": len(orphans), "restored_references": restored,
+        "deleted_images": 0, "deleted_blobs": 0, "reclaimed_bytes": 0, "failed": 0,
+    }
+
+    async def sweep(image_hash: str, blobs: list[BlobInfo]) -> None:
+        # a reference may have been added since the listing
+        async for _ in storage.list_blobs(f"{image_hash}{REFERENCE}"):
+            return
+        # the markers go last, so a partly swept image is found again
+        for blob in sorted(blobs, key=lambda blob: blob.name.endswith(RELEASED)):
+            if not dry_run:
+                try:
+                    await storage.delete(blob.name)
+                except Exception as e:
+                    print(f"Error deleting blob {blob.name}: {e}")
+                    report["failed"] += 1
+                    return
+            report["deleted_blobs"] += 1
+            report["reclaimed_bytes"] += blob.size
+        report["deleted_images"] += 1
+
+    for start in range(0, len(orphans), batch_size):
+        started = time.monotonic()
+        batch = orphans[start:start + batch_size]
+        await asyncio.gather(*(sweep(image_hash, blobs) for image_hash, blobs in batch))
+        # spreads the deletes so the sweep does not compete with serving
+        delay = sum(len(blobs) for _, blobs in batch) / deletes_per_second - (time.monotonic() - started)
+        if delay > 0 and start + batch_size < len(orphans):
+            await asyncio.sleep(delay)
+    return report
+
+
+async def main() -> None:
+    from shared.azure.access_azure_storage import AzureBlobHandler
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events-database", default=os.getenv("EVENTS_DATABASE_URL"), help="SQLAlchemy URL of the event service database, defaults to EVENTS_DATABASE_URL")
+    parser.add_argument("--users-database", default=os.getenv("USERS_DATABASE_URL"), help="SQLAlchemy URL of the user service database, defaults to USERS_DATABASE_URL")
+    parser.add_argument("--dry-run", action="store_true", help="report what would be deleted without deleting it")
+    parser.add_argument("--grace-seconds", type=int, help="overrides BLOB_GC_GRACE_SECONDS")
+    args = parser.parse_args()
+    if not args.events_database or not args.users_database:
+        parser.error("refusing to sweep without both the events and the users database")
+    in_use = combined_in_use(
+        database_in_use(args.events_database, "events", "event"),
+        database_in_use(args.users_database, "user_profiles", "user"),
+    )
+
+    images = os.path.join(os.path.dirname(__file__), "images")
+    handler = AzureBlobHandler(os.path.join(images, "default-event.jpg"))
+    profile_handler = AzureBlobHandler(os.path.join(images, "default-profile.png"), storage=handler.storage)
+    if args.grace_seconds is not None:
+        handler.gc_grace_period = timedelta(seconds=args.grace_seconds)
+    try:
+        report = await handler.sweep(in_use, protected=[profile_handler.default_image_hash], dry_run=args.dry_run)
+    finally:
+        await handler.storage.close()
+    print(f"Done sweeping: {report}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,247 @@
+from abc import ABC, abstractmethod
+import asyncio
+from datetime import datetime, timezone
+import os
+import re
+import tempfile
+from typing import AsyncIterator, NamedTuple
+
+from azure.core.exceptions import ResourceNotFoundError
+from azure.identity.aio import ClientSecretCredential
+from azure.storage.blob import BlobBlock, ContentSettings
+from azure.storage.blob.aio import BlobServiceClient, ContainerClient
+
+DEFAULT_CONTENT_TYPE = "application/octet-stream"
+# hashes, legacy .txt blobs and derived keys, never paths
+BLOB_NAME = re.compile(r"[0-9A-Za-z][0-9A-Za-z._-]*")
+
+
+class BlobNotFound(Exception):
+    pass
+
+
+class BlobInfo(NamedTuple):
+    name: str
+    size: int
+    last_modified: datetime
+
+
+class BlobStorage(ABC):
+    """Flat namespace of blobs, each holding bytes and a content type."""
+
+    @abstractmethod
+    async def upload(self, name: str, data: bytes, content_type: str) -> None:
+        pass
+
+    @abstractmethod
+    async def download(self, name: str) -> tuple[str, bytes]:
+        """Return the content type and bytes of a blob, raising BlobNotFound if it does not exist."""
+        pass
+
+    @abstractmethod
+    async def exists(self, name: str) -> bool:
+        pass
+
+    @abstractmethod
+    async def delete(self, name: str) -> None:
+        pass
+
+    @abstractmethod
+    def list_blobs(self, prefix: str = "") -> AsyncIterator[BlobInfo]:
+        """Yield the blobs whose names start with prefix."""
+        pass
+
+    async def close(self) -> None:
+        pass
+
+
+class AzureBlobStorage(BlobStorage):
+    """Blobs in an Azure storage container.
+
+    The credentials are read from the environment and the client created
+    on first use, so importing or constructing it needs no Azure settings.
+    Blobs larger than a block are staged as blocks uploaded in parallel
+    and then committed, instead of in a single put.
+    """
+
+    def __init__(self, container_name: str = 'crashoutpicstorage'):
+        self.container_name = container_name
+        self.block_size = int(os.getenv("BLOB_BLOCK_SIZE", 4 * 1024 * 1024))
+        self.upload_concurrency = int(os.getenv("BLOB_UPLOAD_CONCURRENCY", 4))
+        self.credentials: ClientSecretCredential | None = None
+        self.blob_service_client: BlobServiceClient | None = None
+        self._container_client: ContainerClient | None = None
+
+    @property
+    def container_client(self) -> ContainerClient:
+        if self._container_client is None:
+            self.credentials = ClientSecretCredential(
+                client_id=os.environ['AZURE_CLIENT_ID'],
+                client_secret=os.environ['AZURE_CLIENT_SECRET'],
+                tenant_id=os.environ['AZURE_TENANT_ID'],
+            )
+            self.blob_service_client = BlobServiceClient(account_url=os.environ["AZURE_STORAGE_URL"], credential=self.credentials)
+            self._container_client = self.blob_service_client.get_container_client(container=self.container_name)
+        return self._container_client
+
+    async def upload(self, name: str, data: bytes, content_type: str) -> None:
+        content_settings = ContentSettings(content_type=content_type)
+        if len(data) <= self.block_size:
+            await self.container_client.upload_blob(name=name, data=data, overwrite=True, content_settings=content_settings)
+            return
+        blob_client = self.container_client.get_blob_client(blob=name)
+        semaphore = asyncio.Semaphore(self.upload_concurrency)
+        # slices of a memoryview share the upload's buffer instead of copying it
+        view = memoryview(data)
+        offsets = range(0, len(data), self.block_size)
+        # ids must have the same length within a blob
+        block_ids = [f"{index:06d}" for index in range(len(offsets))]
+
+        async def stage(block_id: str, offset: int) -> None:
+            async with semaphore:
+                chunk = view[offset:offset + self.block_size]
+                await blob_client.stage_block(block_id, chunk, length=len(chunk))
+
+        await asyncio.gather(*(stage(block_id, offset) for block_id, offset in zip(block_ids, offsets)))
+        await blob_client.commit_block_list([BlobBlock(block_id=block_id) for block_id in block_ids], content_settings=content_settings)
+
+    async def download(self, name: str) -> tuple[str, bytes]:
+        try:
+            download = await self.container_client.get_blob_client(blob=name).download_blob()
+            body = await download.readall()
+        except ResourceNotFoundError as e:
+            raise BlobNotFound(name) from e
+        return download.properties.content_settings.content_type or DEFAULT_CONTENT_TYPE, body
+
+    async def exists(self, name: str) -> bool:
+        return await self.container_client.get_blob_client(blob=name).exists()
+
+    async def delete(self, name: str) -> None:
+        try:
+            await self.container_client.delete_blob(name)
+        except ResourceNotFoundError:
+            pass
+
+    async def list_blobs(self, prefix: str = "") -> AsyncIterator[BlobInfo]:
+        async for blob in self.container_client.list_blobs(name_starts_with=prefix or None):
+            yield BlobInfo(blob.name, blob.size, blob.last_modified)
+
+    async def close(self) -> None:
+        if self.blob_service_client is not None:
+            await self.blob_service_client.close()
+        if self.credentials is not None:
+            await self.credentials.close()
+
+
+class LocalBlobStorage(BlobStorage):
+    """Blobs as files in a local directory, for single node deployments.
+
+    Each file is a content type line followed by the blob bytes. Writes go
+    to a temporary file that is renamed into place, so concurrent readers
+    never see partial blobs. File I/O runs in worker threads.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, name: str) -> str:
+        if not BLOB_NAME.fullmatch(name):
+            raise ValueError(f"Invalid blob name {name}")
+        return os.path.join(self.directory, name)
+
+    def _write(self, name: str, data: bytes, content_type: str) -> None:
+        path = self._path(name)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(content_type.encode('ascii') + b"\n")
+                file.write(data)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def _read(self, name: str) -> tuple[str, bytes]:
+        try:
+            with open(self._path(name), "rb") as file:
+                content_type = file.readline().rstrip(b"\n").decode('ascii')
+                return content_type or DEFAULT_CONTENT_TYPE, file.read()
+        except FileNotFoundError as e:
+            raise BlobNotFound(name) from e
+
+    def _delete(self, name: str) -> None:
+        try:
+            os.remove(self._path(name))
+        except FileNotFoundError:
+            pass
+
+    async def upload(self, name: str, data: bytes, content_type: str) -> None:
+        await asyncio.to_thread(self._write, name, data, content_type)
+
+    async def download(self, name: str) -> tuple[str, bytes]:
+        return await asyncio.to_thread(self._read, name)
+
+    async def exists(self, name: str) -> bool:
+        return await asyncio.to_thread(os.path.exists, self._path(name))
+
+    async def delete(self, name: str) -> None:
+        await asyncio.to_thread(self._delete, name)
+
+    def _scan(self, prefix: str) -> list[BlobInfo]:
+        blobs = []
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith(".") or not entry.name.startswith(prefix):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            blobs.append(BlobInfo(entry.name, stat.st_size, datetime.fromtimestamp(stat.st_mtime, timezone.utc)))
+        return blobs
+
+    async def list_blobs(self, prefix: str = "") -> AsyncIterator[BlobInfo]:
+        for blob in await asyncio.to_thread(self._scan, prefix):
+            yield blob
+
+
+class MemoryBlobStorage(BlobStorage):
+    """Blobs in a dict, for tests and benchmarks."""
+
+    def __init__(self):
+        self.blobs: dict[str, tuple[str, bytes]] = {}
+        self.modified: dict[str, datetime] = {}
+
+    async def upload(self, name: str, data: bytes, content_type: str) -> None:
+        self.blobs[name] = (content_type, data)
+        self.modified[name] = datetime.now(timezone.utc)
+
+    async def download(self, name: str) -> tuple[str, bytes]:
+        try:
+            return self.blobs[name]
+        except KeyError as e:
+            raise BlobNotFound(name) from e
+
+    async def exists(self, name: str) -> bool:
+        return name in self.blobs
+
+    async def delete(self, name: str) -> None:
+        self.blobs.pop(name, None)
+        self.modified.pop(name, None)
+
+    async def list_blobs(self, prefix: str = "") -> AsyncIterator[BlobInfo]:
+        for name in sorted(self.blobs):
+            if name.startswith(prefix):
+                yield BlobInfo(name, len(self.blobs[name][1]), self.modified[name])
+
+
+def create_blob_storage(backend: str | None = None) -> BlobStorage:
+    """Create the storage named by backend, or by BLOB_STORAGE when not given."""
+    backend = backend or os.getenv("BLOB_STORAGE", "azure")
+    if backend == "azure":
+        return AzureBlobStorage()
+    if backend == "local":
+        return LocalBlobStorage(os.getenv("BLOB_STORAGE_DIR", "blobs"))
+    if backend == "memory":
+        return MemoryBlobStorage()
+    raise ValueError(f"Unknown blob storage backend {backend}")
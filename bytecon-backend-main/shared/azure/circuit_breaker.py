@@ -0,0 +1,58 @@
+import time
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """Stops calling a failing dependency until it recovers.
+
+    After failure_threshold consecutive failures the circuit opens and
+    allow() returns False, so callers fail fast instead of waiting on a
+    degraded service. Once every reset_timeout seconds one call is let
+    through as a probe, and a success closes the circuit again.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: float | None = None
+        self.trips = 0
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        return "closed" if self.opened_at is None else "open"
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        now = time.monotonic()
+        if now - self.opened_at >= self.reset_timeout:
+            # the probe restarts the window, so a probe that never reports back is retried later
+            self.opened_at = now
+            return True
+        self.rejected += 1
+        return False
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.opened_at is not None:
+            self.opened_at = time.monotonic()
+        elif self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            self.trips += 1
+
+    def stats(self) -> dict[str, int | str]:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "trips": self.trips,
+            "rejected": self.rejected,
+        }
@@ -0,0 +1,43 @@
+import base64
+import re
+from urllib.parse import unquote_to_bytes
+
+# content type of uploads that were not data URLs, kept as the exact string
+VERBATIM = "application/x-verbatim"
+OPAQUE = "application/octet-stream"
+# type/subtype in the ASCII characters RFC 6838 allows, stored as a line in local files
+CONTENT_TYPE = re.compile(r"[a-z0-9][a-z0-9!#$&^_.+-]*/[a-z0-9][a-z0-9!#$&^_.+-]*", re.ASCII | re.IGNORECASE)
+
+
+def safe_content_type(content_type: str) -> str:
+    """Keep raster image types for responses, anything a browser could run, such as HTML or SVG, becomes opaque bytes."""
+    content_type = content_type.strip().lower()
+    if not CONTENT_TYPE.fullmatch(content_type):
+        return OPAQUE
+    if content_type.startswith("image/") and content_type != "image/svg+xml":
+        return content_type
+    return OPAQUE
+
+
+def decode_data_url(data: str) -> tuple[str, bytes]:
+    """Split an uploaded image string into its content type and raw bytes.
+
+    Raises ValueError when the base64 payload is malformed.
+    """
+    if not data.startswith("data:"):
+        return VERBATIM, data.encode('utf-8')
+    header, _, payload = data.partition(",")
+    content_type = header[len("data:"):].split(";")[0].strip()
+    if not CONTENT_TYPE.fullmatch(content_type):
+        # would break the line based storage formats
+        content_type = OPAQUE
+    if header.endswith(";base64"):
+        return content_type, base64.b64decode(payload)
+    return content_type, unquote_to_bytes(payload)
+
+
+def encode_data_url(content_type: str, body: bytes) -> str:
+    """Build the string GraphQL returns for a stored image."""
+    if content_type == VERBATIM:
+        return body.decode('utf-8')
+    return f"data:{content_type};base64," + base64.b64encode(body).decode('utf-8')
@@ -0,0 +1,61 @@
+import re
+from typing import Callable
+
+from fastapi import APIRouter, HTTPException, Request, Response
+
+from shared.azure.access_azure_storage import AzureBlobHandler
+from shared.azure.image_format import safe_content_type
+
+IMAGE_HASH = re.compile(r"[0-9a-f]{64}")
+# images are addressed by the hash of their content, so they never change
+IMMUTABLE = "public, max-age=31536000, immutable"
+# uploads are untrusted, never let a browser sniff or run them as a page
+UNTRUSTED_CONTENT_HEADERS = {
+    "X-Content-Type-Options": "nosniff",
+    "Content-Security-Policy": "default-src 'none'; sandbox",
+}
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if if_none_match is None:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
+def image_response(entry: tuple[str, bytes], headers: dict[str, str]) -> Response:
+    content_type, body = entry
+    # uploads keep the type they were sent with, only what is served is restricted
+    return Response(content=body, media_type=safe_content_type(content_type), headers={**headers, **UNTRUSTED_CONTENT_HEADERS})
+
+
+def create_image_router(get_handler: Callable[[], AzureBlobHandler]) -> APIRouter:
+    router = APIRouter()
+
+    @router.get("/images/{image_hash}")
+    async def get_image(image_hash: str, request: Request) -> Response:
+        if not IMAGE_HASH.fullmatch(image_hash):
+            raise HTTPException(status_code=404, detail="Image not found")
+        etag = f'"{image_hash}"'
+        headers = {"ETag": etag, "Cache-Control": IMMUTABLE}
+        if etag_matches(request.headers.get("If-None-Match"), etag):
+            return Response(status_code=304, headers=headers)
+        entry = await get_handler().fetch_image(image_hash)
+        if entry is None:
+            raise HTTPException(status_code=404, detail="Image not found")
+        return image_response(entry, headers)
+
+    @router.get("/images/{image_hash}/thumbnail")
+    async def get_thumbnail(image_hash: str, request: Request) -> Response:
+        if not IMAGE_HASH.fullmatch(image_hash):
+            raise HTTPException(status_code=404, detail="Image not found")
+        etag = f'"{image_hash}-thumbnail"'
+        headers = {"ETag": etag, "Cache-Control": IMMUTABLE}
+        if etag_matches(request.headers.get("If-None-Match"), etag):
+            return Response(status_code=304, headers=headers)
+        entry = await get_handler().fetch_thumbnail(image_hash)
+        if entry is None:
+            raise HTTPException(status_code=404, detail="Image not found")
+        return image_response(entry, headers)
+
+    return router
@@ -0,0 +1,79 @@
+"""Rewrite legacy `{hash}.txt` image blobs in the binary format.
+
+Legacy blobs hold the uploaded data URL string. Each one is rewritten as a
+`{hash}` blob of the raw image bytes with its content type. The services
+read both formats, so this can run while they are serving. The legacy
+blob is only deleted with --delete-legacy, after its content was checked
+against its hash.
+
+    python -m shared.azure.migrate_blobs [--delete-legacy] [--concurrency N]
+"""
+import argparse
+import asyncio
+import hashlib
+import os
+
+from shared.azure.access_azure_storage import AzureBlobHandler
+from shared.azure.image_format import decode_data_url
+
+BATCH_SIZE = 100
+
+
+async def migrate_blob(handler: AzureBlobHandler, legacy_name: str, delete_legacy: bool) -> str:
+    image_hash = legacy_name.removesuffix(".txt")
+    storage = handler.storage
+    if await storage.exists(image_hash):
+        outcome = "skipped"
+    else:
+        _, data_bytes = await storage.download(legacy_name)
+        data = data_bytes.decode('utf-8')
+        if hashlib.sha256(data.encode('utf-8')).hexdigest() != image_hash:
+            return "mismatched"
+        content_type, body = decode_data_url(data)
+        await storage.upload(image_hash, body, content_type)
+        outcome = "migrated"
+    if delete_legacy:
+        await storage.delete(legacy_name)
+    return outcome
+
+
+async def migrate_legacy_blobs(handler: AzureBlobHandler, delete_legacy: bool = False, concurrency: int = 8) -> dict[str, int]:
+    semaphore = asyncio.Semaphore(concurrency)
+    counts = {"migrated": 0, "skipped": 0, "mismatched": 0, "failed": 0}
+
+    async def migrate(legacy_name: str) -> None:
+        async with semaphore:
+            try:
+                counts[await migrate_blob(handler, legacy_name, delete_legacy)] += 1
+            except Exception as e:
+                print(f"Error migrating {legacy_name}: {e}")
+                counts["failed"] += 1
+
+    batch: list[str] = []
+    async for blob in handler.storage.list_blobs():
+        if blob.name.endswith(".txt"):
+            batch.append(blob.name)
+        if len(batch) == BATCH_SIZE:
+            await asyncio.gather(*(migrate(name) for name in batch))
+            print(counts)
+            batch = []
+    await asyncio.gather(*(migrate(name) for name in batch))
+    return counts
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--delete-legacy", action="store_true", help="delete each .txt blob once its binary blob exists")
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    handler = AzureBlobHandler(os.path.join(os.path.dirname(__file__), "images", "default-event.jpg"))
+    try:
+        counts = await migrate_legacy_blobs(handler, args.delete_legacy, args.concurrency)
+    finally:
+        await handler.storage.close()
+    print(f"Done migrating: {counts}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
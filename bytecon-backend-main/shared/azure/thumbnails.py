@@ -0,0 +1,37 @@
+from io import BytesIO
+
+from PIL import Image, UnidentifiedImageError, features
+
+THUMBNAIL_SIZE = 320
+THUMBNAIL_QUALITY = 80
+# stored under the thumbnail name when the original is served instead
+USE_ORIGINAL = "application/x-use-original"
+
+
+def thumbnail_name(image_hash: str) -> str:
+    """Blob and cache key of the thumbnail of an image."""
+    return f"{image_hash}-thumb{THUMBNAIL_SIZE}"
+
+
+def make_thumbnail(content_type: str, body: bytes) -> tuple[str, bytes] | None:
+    """Scale an image to fit THUMBNAIL_SIZE, as WebP when Pillow supports it.
+
+    Returns None for anything Pillow cannot read, including images too
+    large to decode safely, and for images the thumbnail would not make
+    smaller, whose original is served instead.
+    """
+    try:
+        image = Image.open(BytesIO(body))
+        image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        output = BytesIO()
+        if features.check("webp"):
+            image.save(output, format="WEBP", quality=THUMBNAIL_QUALITY)
+            thumbnail = ("image/webp", output.getvalue())
+        else:
+            image.convert("RGB").save(output, format="JPEG", quality=THUMBNAIL_QUALITY, optimize=True)
+            thumbnail = ("image/jpeg", output.getvalue())
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, ValueError):
+        return None
+    if len(thumbnail[1]) >= len(body):
+        return None
+    return thumbnail
@@ -6,6 +6,7 @@ class MessageType(Enum):
     DELETEUSER = 1
     EDITEVENT = 2
     DELETEEVENT = 3
+    EVENTCHANGED = 4
 
 class Tags(Enum):
     ARTIFICIAL_INTELLIGENCE = "ARTIFICIAL INTELLIGENCE"
@@ -35,4 +36,11 @@ class EditEvent(BaseModel):
 
 class DeleteEvent(BaseModel):
     message_type: MessageType
-    event_id: int
\ No newline at end of file
+    event_id: int
+
+class EventChanged(BaseModel):
+    message_type: MessageType
+    event_id: int
+    # None when the event was deleted
+    name: str | None
+    datetime: datetime | None
@@ -41,7 +41,8 @@ class RabbitConsumer:
                     raise e
         if self.connection:
             self.channel = await self.connection.channel()
-            self.queue = await self.channel.declare_queue("db-synchronise")
+            # durable like the producer's declaration, which it has to match
+            self.queue = await self.channel.declare_queue("db-synchronise", durable=True)
 
     async def on_message(self, message: AbstractIncomingMessage) -> None:
         payload_json = json.loads(message.body.decode('utf-8')) 
@@ -73,8 +73,14 @@ async def edit_profile_pic(self, input: EditImageInput, info: strawberry.Info) -
     img = await app.get_azure_blob_handler().upload_blob(input.image)
     result = await db.execute(select(UserProfileTable).filter(UserProfileTable.id == user.id))
     user_ = result.scalars().first()
+    previous_image = user_.image
+    if img != previous_image:
+        # before the commit, so no profile uses an image the sweeper may delete
+        await app.get_azure_blob_handler().add_reference(img, f"user-{user.id}") # type: ignore
     user_.image = img
     await db.commit()
+    if img != previous_image:
+        await app.get_azure_blob_handler().remove_reference(previous_image, f"user-{user.id}") # type: ignore
     return IDReturn(id=strawberry.ID(str(user.id)))
 
 
@@ -188,7 +194,7 @@ async def user_profile(self, info: strawberry.Info) -> UserProfile:
             await db.commit()
         user_dict = {c.key: getattr(user_db, c.key) for c in inspect(UserTable).mapper.column_attrs}
         user_profile_db = await db.get(UserProfileTable, token_data.id)
-        img_blob = await app.get_azure_blob_handler().get_blob(user_profile_db.image) # type: ignore
+        img_blob = await app.get_azure_blob_handler().get_image(user_profile_db.image) # type: ignore
         return UserProfile(
             user=User.from_pydantic(UserModel.model_validate(user_dict)),
             bio=user_profile_db.bio,
@@ -1,4 +1,6 @@
 from functools import cached_property
+import asyncio
+import os
 
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
@@ -9,7 +11,10 @@ from oauth2 import verify_access_token
 from api.schema import TokenData
 from api.resolvers import schema
 from contextlib import asynccontextmanager
+from sqlalchemy import select
+from models import UserProfileTable, get_session
 from shared.azure.access_azure_storage import AzureBlobHandler
+from shared.azure.image_routes import create_image_router
 import shared.rabbitmq.rabbit_provider as rabbit_provider
 
 class Context(BaseContext):
@@ -45,10 +50,18 @@ rabbit_producer = rabbit_provider.RabbitProducer()
 def get_rabbit_producer() -> rabbit_provider.RabbitProducer:
     return rabbit_producer
 
+async def backfill_image_references() -> None:
+    async with get_session() as db:
+        rows = (await db.execute(select(UserProfileTable.id, UserProfileTable.image))).all()
+    await azure_blob_handler.backfill_references((image, f"user-{id}") for id, image in rows)
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Connect to RabbitMQ when application starts
     await rabbit_producer.connect()
+    # the event service sweeps unreferenced images, including profile pictures
+    if os.getenv("BLOB_REFERENCE_BACKFILL", "false").lower() in ("1", "true"):
+        asyncio.create_task(backfill_image_references())
     yield
     # Close the RabbitMQ connection when application shuts down
     await rabbit_producer.close()
@@ -63,4 +76,13 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-app.include_router(graphql_app, prefix="/graphql")
\ No newline at end of file
+app.include_router(graphql_app, prefix="/graphql")
+app.include_router(create_image_router(get_azure_blob_handler))
+
+@app.get("/stats/cache")
+def cache_stats() -> dict[str, dict[str, int | str]]:
+    return {
+        "blobs": azure_blob_handler.cache.stats(),
+        "blob_fetches": azure_blob_handler.stats(),
+        "sync_messages": rabbit_producer.stats(),
+    }